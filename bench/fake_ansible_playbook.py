@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+"""A stand-in for ansible-playbook, used by the benchmarks. It prints a block of output per task
+and, like the box_trace callback plugin, appends a span per task to $MYSTERY_BOX_TRACE.
+
+Environment:
+  BOX_BENCH_TASKS         tasks per playbook. [default: 10]
+  BOX_BENCH_TASK_SECONDS  seconds each task takes. [default: 0.01]
+  BOX_BENCH_TASK_LINES    output lines per task. [default: 100]
+"""
+
+import os
+import sys
+import json
+import time
+
+TASKS = int(os.environ.get('BOX_BENCH_TASKS', '10'))
+TASK_SECONDS = float(os.environ.get('BOX_BENCH_TASK_SECONDS', '0.01'))
+TASK_LINES = int(os.environ.get('BOX_BENCH_TASK_LINES', '100'))
+
+
+def main(args: list[str]) -> None:
+    trace_path = os.environ.get('MYSTERY_BOX_TRACE')
+    playbook = args[-1] if args else 'playbook'
+
+    print(f'PLAY [{playbook}]', flush=True)
+
+    for idx in range(TASKS):
+        start = time.time()
+        print(f'TASK [task {idx}]')
+
+        for line in range(TASK_LINES):
+            print(f'ok: [localhost] => line {line}')
+
+        sys.stdout.flush()
+        time.sleep(TASK_SECONDS)
+
+        if trace_path:
+            with open(trace_path, 'a') as conn:
+                conn.write(json.dumps({'name': f'task {idx}', 'start': start, 'end': time.time(), 'status': 'ok'}) + '\n')
+
+    print(f'PLAY RECAP: ok={TASKS}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
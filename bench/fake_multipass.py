@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""A stand-in for the multipass CLI, used by the benchmarks. Instances are entries in a JSON state
+file, each given a distinct loopback address, and every call sleeps to mimic multipass latency.
+
+Environment:
+  BOX_BENCH_STATE      the JSON state file.
+  BOX_BENCH_LATENCY    seconds each call takes. [default: 0.05]
+  BOX_BENCH_BOOT       seconds an instance takes to launch; starting takes half as long, and resuming
+                       a suspended instance a tenth as long. [default: 0.5]
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+
+STATE = os.environ['BOX_BENCH_STATE']
+LATENCY = float(os.environ.get('BOX_BENCH_LATENCY', '0.05'))
+BOOT = float(os.environ.get('BOX_BENCH_BOOT', '0.5'))
+
+
+def address(state: dict) -> str:
+    """Pick an unused loopback address; the stand-in SSH server listens on all of them"""
+    used = {inst['ip'] for inst in state.values()}
+    return next(f'127.0.0.{idx}' for idx in range(1, 255) if f'127.0.0.{idx}' not in used)
+
+
+def info(state: dict) -> None:
+    if not state:
+        print('info failed: No instances found.', file=sys.stderr)
+        exit(2)
+
+    print(json.dumps({
+        'errors': [],
+        'info': {name: {
+            'state': inst['state'],
+            'ipv4': [inst['ip']] if inst['state'] == 'Running' else [],
+            'mounts': inst.get('mounts', {})
+        } for name, inst in state.items()}
+    }))
+
+
+def read_state() -> dict:
+    if not os.path.exists(STATE):
+        return {}
+
+    with open(STATE) as conn:
+        return json.load(conn)
+
+
+def main(args: list[str]) -> None:
+    command = args[0]
+    time.sleep(LATENCY)
+
+    if command == 'launch':
+        sys.stdin.read()
+        time.sleep(BOOT)
+    elif command == 'start':
+        suspended = read_state().get(args[1], {}).get('state') == 'Suspended'
+        time.sleep(BOOT / 10 if suspended else BOOT / 2)
+    elif command == 'clone':
+        time.sleep(BOOT / 4)
+
+    with open(STATE + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        state = read_state()
+
+        if command == 'info':
+            info(state)
+            return
+        elif command == 'launch':
+            state[args[args.index('-n') + 1]] = {'state': 'Running', 'ip': address(state)}
+        elif command == 'clone':
+            state[args[args.index('-n') + 1]] = {'state': 'Stopped', 'ip': address(state)}
+        elif command == 'start':
+            state[args[1]]['state'] = 'Running'
+        elif command == 'stop':
+            state[args[1]]['state'] = 'Stopped'
+        elif command == 'suspend':
+            state[args[1]]['state'] = 'Suspended'
+        elif command == 'mount':
+            name, target = args[2].split(':', 1)
+            state[name].setdefault('mounts', {})[target] = {'source_path': args[1]}
+        elif command == 'umount':
+            name, target = args[1].split(':', 1)
+            state[name].get('mounts', {}).pop(target, None)
+        elif command == 'delete':
+            state.pop(args[1], None)
+
+        with open(STATE, 'w') as conn:
+            json.dump(state, conn)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""Mystery-Box mount benchmark
+
+Compares a `mode: mount` copy entry against a copied one, on a real Multipass instance. A tree of
+files is copied into the instance and mounted beside it, and then read from each location, cold
+(with the instance's page cache dropped) and warm. Needs multipass, and launches one instance,
+which is deleted afterwards unless --keep is passed.
+
+Usage:
+  mount.py [--name <str>] [--files <n>] [--size <bytes>] [--repeat <n>] [--keep]
+  mount.py (-h|--help)
+
+Options:
+  --name <str>    the instance to benchmark on; it is launched if it does not exist. [default: box-bench-mount]
+  --files <n>     how many files the tree holds. [default: 2000]
+  --size <bytes>  the size of each file. [default: 65536]
+  --repeat <n>    how many times to run each read; the median is reported. [default: 3]
+  --keep          keep the instance afterwards.
+  -h,--help       show this documentation
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+from typing import Callable
+
+BENCH = Path(__file__).resolve().parent
+REPO = BENCH.parent
+
+# -- read-heavy workloads, run as root on the instance against a tree
+WORKLOADS = {
+    'walk': 'find {tree} -type f | wc -l',
+    'read every file': 'find {tree} -type f -exec cat {{}} + > /dev/null',
+    'grep': 'grep -r -c box-bench {tree} > /dev/null || true'
+}
+
+DROP_CACHES = 'sync && echo 3 > /proc/sys/vm/drop_caches'
+
+
+def exec_root(name: str, cmd: str) -> None:
+    subprocess.run(['multipass', 'exec', name, '--', 'sudo', 'sh', '-c', cmd],
+                   stdout=subprocess.DEVNULL, check=True)
+
+
+def timed(action: Callable) -> float:
+    start_time = time.perf_counter()
+    action()
+
+    return time.perf_counter() - start_time
+
+
+class MountBench:
+    """A tree of files on the host, and an instance that receives it by copy and by mount"""
+
+    def __init__(self, workdir: Path, opts: dict) -> None:
+        self.workdir = workdir
+        self.name = opts['--name']
+        self.repeat = int(opts['--repeat'])
+        self.tree = workdir / 'tree'
+
+        sys.path.insert(0, str(REPO / 'box'))
+
+        self.create_inputs(int(opts['--files']), int(opts['--size']))
+
+    def create_inputs(self, files: int, size: int) -> None:
+        """Write the tree, spread over nested folders as a checkout would be, and a box.yaml mounting it"""
+        for idx in range(files):
+            fpath = self.tree / f'{idx % 16:02}' / f'{idx // 16 % 16:02}' / f'file-{idx}.txt'
+            fpath.parent.mkdir(parents=True, exist_ok=True)
+            fpath.write_bytes(os.urandom(size))
+
+        (self.workdir / 'keys').mkdir()
+        (self.workdir / 'playbook.yaml').write_text('- hosts: all\n  tasks: []\n')
+        (self.workdir / 'box.yaml').write_text(json.dumps({
+            'user': 'bench',
+            'memory': '2G',
+            'disk': '10G',
+            'playbooks': [str(self.workdir / 'playbook.yaml')],
+            'copy': [{'src': str(self.tree), 'dest': '/srv/mounted', 'mode': 'mount'}],
+            'key_folder': str(self.workdir / 'keys')
+        }))
+
+    def up(self) -> None:
+        from src.box.hardware_backends import DevBoxMultipass
+        DevBoxMultipass(self.name).up({'config': str(self.workdir / 'box.yaml')})
+
+    def copy(self) -> None:
+        from src.box.scp import SCP
+        from src.box.multipass import Multipass
+
+        exec_root(self.name, 'rm -rf /srv/copied')
+
+        with SCP('root', Multipass.ip(self.name)) as scp:
+            scp.copy(self.workdir / 'keys', self.tree, '/srv/copied')
+
+    def mount(self) -> None:
+        from src.box.multipass import Multipass
+        from src.box.hardware_backends import DevBoxMultipass
+
+        cfg = DevBoxMultipass(self.name).load_config(str(self.workdir / 'box.yaml'))
+
+        Multipass.umount(self.name, '/srv/mounted')
+        Multipass.sync_mounts(self.name, cfg.mounts)
+
+    def read(self, workload: str, tree: str, cold: bool) -> float:
+        timings = []
+
+        for _ in range(self.repeat):
+            if cold:
+                exec_root(self.name, DROP_CACHES)
+
+            timings.append(timed(lambda: exec_root(self.name, WORKLOADS[workload].format(tree=tree))))
+
+        return statistics.median(timings)
+
+    def run(self) -> dict:
+        self.up()
+
+        results = {
+            'set up': {
+                'copy': statistics.median([timed(self.copy) for _ in range(self.repeat)]),
+                'mount': statistics.median([timed(self.mount) for _ in range(self.repeat)])
+            }
+        }
+
+        for workload in WORKLOADS:
+            for cold in (True, False):
+                results[f"{workload}, {'cold' if cold else 'warm'}"] = {
+                    'copy': self.read(workload, '/srv/copied', cold),
+                    'mount': self.read(workload, '/srv/mounted', cold)
+                }
+
+        return results
+
+
+def report(results: dict) -> None:
+    print(f"{'benchmark':<28} {'copy':>9} {'mount':>9} {'mount/copy':>11}")
+
+    for name, timings in results.items():
+        ratio = timings['mount'] / timings['copy'] if timings['copy'] else float('inf')
+        print(f"{name:<28} {timings['copy']:>9.3f} {timings['mount']:>9.3f} {ratio:>10.2f}x")
+
+
+def main() -> None:
+    from docopt import docopt
+    opts = docopt(__doc__)
+
+    if not shutil.which('multipass'):
+        print('📦 the mount benchmark needs multipass', file=sys.stderr)
+        exit(1)
+
+    # -- the multipass snap can only mount folders under the home directory
+    with tempfile.TemporaryDirectory(prefix='.box-bench-mount-', dir=Path.home()) as workdir:
+        bench = MountBench(Path(workdir), opts)
+
+        try:
+            report(bench.run())
+        finally:
+            if not opts['--keep']:
+                from src.box.hardware_backends import DevBoxMultipass
+                DevBoxMultipass(bench.name).delete()
+
+
+if __name__ == '__main__':
+    main()
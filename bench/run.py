@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""Mystery-Box benchmarks
+
+Runs `box` against a fake multipass executable and an in-process SSH/SFTP server, so it needs
+no VM and no network, and compares the timings to a saved baseline.
+
+Usage:
+  run.py [--repeat <n>] [--tolerance <pct>] [--latency <s>] [--boot <s>] [--baseline <file>] [--save]
+  run.py (-h|--help)
+
+Options:
+  --repeat <n>       how many times to run each benchmark; the median is reported. [default: 3]
+  --tolerance <pct>  how much slower than the baseline a benchmark may be before it is flagged. [default: 20]
+  --latency <s>      seconds each fake multipass call takes. [default: 0.05]
+  --boot <s>         seconds a fake multipass launch takes. [default: 0.5]
+  --baseline <file>  the baseline to compare against. [default: bench/baseline.json]
+  --save             save these results as the new baseline.
+  -h,--help          show this documentation
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+from contextlib import redirect_stdout
+from typing import Callable
+
+BENCH = Path(__file__).resolve().parent
+REPO = BENCH.parent
+
+SMALL_FILES = 500
+SMALL_SIZE = 4 * 1024
+LARGE_SIZE = 128 * 1024 ** 2
+
+
+class Bench:
+    """A sandbox holding fake multipass state, an SSH server root standing in for the instance,
+    box's cache folder and a box.yaml, with the box modules imported against it"""
+    workdir: Path
+
+    def __init__(self, workdir: Path, opts: dict) -> None:
+        self.workdir = workdir
+        self.root = workdir / 'instance'
+        self.env = self.environ(opts)
+
+        os.environ.update(self.env)
+        sys.path.insert(0, str(REPO / 'box'))
+
+        from ssh_server import serve
+        from src.box.utils import logging
+        from src.box.connections import ConnectionPool
+
+        # -- report failures only; progress messages would drown the results
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('paramiko.transport').setLevel(logging.CRITICAL)
+
+        self.root.mkdir()
+        ConnectionPool.port = serve(self.root, {**self.env, 'HOME': str(self.root)})
+
+        self.create_inputs()
+
+    def environ(self, opts: dict) -> dict:
+        """Put the fake multipass and ansible-playbook executables on the PATH"""
+        bin_folder = self.workdir / 'bin'
+        bin_folder.mkdir()
+
+        for name, script in [('multipass', 'fake_multipass.py'), ('ansible-playbook', 'fake_ansible_playbook.py')]:
+            (bin_folder / name).symlink_to(BENCH / script)
+            (BENCH / script).chmod(0o755)
+
+        return {
+            'PATH': f'{bin_folder}{os.pathsep}{os.environ["PATH"]}',
+            'XDG_CACHE_HOME': str(self.workdir / 'cache'),
+            'BOX_BENCH_STATE': str(self.workdir / 'multipass.json'),
+            'BOX_BENCH_LATENCY': opts['--latency'],
+            'BOX_BENCH_BOOT': opts['--boot']
+        }
+
+    def create_inputs(self) -> None:
+        """Write a box.yaml with a playbook, a folder of small files and one large file to copy"""
+        keys = self.workdir / 'keys'
+        small = self.workdir / 'small'
+        keys.mkdir()
+        small.mkdir()
+
+        for idx in range(SMALL_FILES):
+            (small / f'file-{idx}.txt').write_bytes(os.urandom(SMALL_SIZE))
+
+        with open(self.workdir / 'large.bin', 'wb') as conn:
+            for _ in range(LARGE_SIZE // 1024 ** 2):
+                conn.write(os.urandom(1024 ** 2))
+
+        (self.workdir / 'playbook.yaml').write_text('- hosts: all\n  tasks: []\n')
+        (self.workdir / 'box.yaml').write_text(json.dumps({
+            'user': 'bench',
+            'memory': '1G',
+            'disk': '5G',
+            'playbooks': [str(self.workdir / 'playbook.yaml')],
+            'copy': [{'src': str(small), 'dest': 'small'}],
+            'key_folder': str(keys)
+        }))
+
+    def reset(self) -> None:
+        """Remove the instance and everything box remembers about it"""
+        from src.box.connections import ConnectionPool
+        from src.box.multipass import Multipass
+        from src.box.manifest import Manifest
+        from src.box.tracing import Tracer
+
+        ConnectionPool.close()
+        Multipass.invalidate()
+        Manifest.memo = {}
+        Tracer.reset()
+
+        for path in [self.root, self.workdir / 'cache']:
+            shutil.rmtree(path, ignore_errors=True)
+
+        self.root.mkdir()
+
+        if os.path.exists(self.env['BOX_BENCH_STATE']):
+            os.remove(self.env['BOX_BENCH_STATE'])
+
+    def devbox(self):
+        from src.box.hardware_backends import DevBoxMultipass
+        return DevBoxMultipass('bench')
+
+    def up(self) -> None:
+        self.reset()
+        self.devbox().up({'config': str(self.workdir / 'box.yaml')})
+
+    def configure(self, opts: dict) -> Callable:
+        def run():
+            vm = self.devbox()
+            vm.configure(vm.load_config(str(self.workdir / 'box.yaml')), opts)
+
+        return run
+
+    def copy(self, jobs: list) -> Callable:
+        def run():
+            from src.box.scp import SCP
+            from src.box.multipass import Multipass
+
+            with SCP('root', Multipass.ip('bench')) as scp:
+                scp.copy_many(self.workdir / 'keys', jobs)
+
+        return run
+
+    def copy_tree(self) -> None:
+        from src.box.scp import SCP
+        from src.box.multipass import Multipass
+
+        with SCP('root', Multipass.ip('bench')) as scp:
+            scp.copy(self.workdir / 'keys', self.workdir / 'small', 'small-tree')
+
+    def cli(self, *args: str) -> Callable:
+        def run():
+            subprocess.run([sys.executable, str(REPO / 'box' / 'main.py'), *args], env={**os.environ, **self.env},
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+        return run
+
+    def benchmarks(self) -> dict:
+        small_jobs = [(path, Path(path.name)) for path in sorted((self.workdir / 'small').iterdir())]
+        large_jobs = [(self.workdir / 'large.bin', Path('large.bin'))]
+
+        return {
+            'up': self.up,
+            'configure unchanged': self.configure({}),
+            'configure forced': self.configure({'force': True, 'all': True}),
+            f'copy {SMALL_FILES} small files': self.copy(small_jobs),
+            f'copy {SMALL_FILES} small files as a tree': self.copy_tree,
+            f'copy {LARGE_SIZE // 1024 ** 2} MiB file': self.copy(large_jobs),
+            'cli --help': self.cli('--help'),
+            'cli ip': self.cli('ip')
+        }
+
+
+def measure(action: Callable, repeat: int) -> float:
+    """The median wall-clock seconds of an action over several runs. Playbook output is discarded"""
+    timings = []
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            action()
+            timings.append(time.perf_counter() - start_time)
+
+    return statistics.median(timings)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """Print each result against its baseline, returning whether any regressed"""
+    regressed = False
+
+    print(f"{'benchmark':<36} {'seconds':>9} {'baseline':>9} {'change':>8}")
+
+    for name, seconds in results.items():
+        line = f'{name:<36} {seconds:>9.3f}'
+        previous = baseline.get(name)
+
+        if previous:
+            change = (seconds - previous) / previous * 100
+            line += f' {previous:>9.3f} {change:>+7.1f}%'
+
+            if change > tolerance:
+                line += '  regressed'
+                regressed = True
+
+        print(line)
+
+    return regressed
+
+
+def main() -> None:
+    from docopt import docopt
+    opts = docopt(__doc__)
+
+    sys.path.insert(0, str(BENCH))
+    baseline_path = REPO / opts['--baseline']
+
+    with tempfile.TemporaryDirectory(prefix='box-bench-') as workdir:
+        bench = Bench(Path(workdir), opts)
+        results = {}
+
+        for name, action in bench.benchmarks().items():
+            results[name] = round(measure(action, int(opts['--repeat'])), 4)
+
+        bench.reset()
+
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+    regressed = compare(results, baseline, float(opts['--tolerance']))
+
+    if opts['--save']:
+        baseline_path.write_text(json.dumps(results, indent=2) + '\n')
+        print(f'📦 saved baseline to {baseline_path}')
+    elif regressed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+
+"""An in-process SSH and SFTP server standing in for a box instance, used by the benchmarks.
+It accepts any public key, maps SFTP paths under a root folder, and runs exec requests with
+`sh` inside that folder, streaming stdin, stdout and stderr like sshd."""
+
+import os
+import socket
+import threading
+import subprocess
+from pathlib import Path
+import paramiko
+from paramiko import SFTPServer, SFTPServerInterface, SFTPAttributes, SFTPHandle, SFTP_OK
+
+
+class RootHandle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+class RootSFTP(SFTPServerInterface):
+    """Serve SFTP requests from beneath a root folder. Relative paths resolve against the root,
+    as they would against the remote user's home"""
+    root: Path
+
+    def __init__(self, server, *args, **kwargs) -> None:
+        super().__init__(server, *args, **kwargs)
+        self.root = server.root
+
+    def resolve(self, path: str) -> str:
+        return str(self.root / os.path.normpath('/' + path).lstrip('/'))
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self.resolve(path), flags, 0o644)
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+
+        handle = RootHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+
+        return handle
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.resolve(path)))
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        try:
+            folder = self.resolve(path)
+            entries = []
+
+            for name in os.listdir(folder):
+                attrs = SFTPAttributes.from_stat(os.stat(os.path.join(folder, name)))
+                attrs.filename = name
+                entries.append(attrs)
+
+            return entries
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+
+    def call(self, action, *paths):
+        try:
+            action(*[self.resolve(path) for path in paths])
+        except OSError as err:
+            return SFTPServer.convert_errno(err.errno)
+
+        return SFTP_OK
+
+    def remove(self, path):
+        return self.call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        return self.call(os.replace, oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        return self.call(os.replace, oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        return self.call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self.call(os.rmdir, path)
+
+    def chattr(self, path, attr):
+        return SFTP_OK
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path)
+
+
+class StandInServer(paramiko.ServerInterface):
+    """Accept any key, and run exec requests as shell commands within the root folder"""
+    root: Path
+    env: dict
+
+    def __init__(self, root: Path, env: dict) -> None:
+        self.root = root
+        self.env = env
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.exec, args=(channel, command.decode('utf8')), daemon=True).start()
+        return True
+
+    def exec(self, channel: paramiko.Channel, command: str) -> None:
+        proc = subprocess.Popen(command, shell=True, cwd=self.root, env=self.env,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def pump_stdin():
+            for chunk in iter(lambda: channel.recv(65536), b''):
+                proc.stdin.write(chunk)
+
+            proc.stdin.close()
+
+        def pump_stderr():
+            for chunk in iter(lambda: proc.stderr.read1(65536), b''):
+                channel.sendall_stderr(chunk)
+
+        pumps = [threading.Thread(target=pump, daemon=True) for pump in [pump_stdin, pump_stderr]]
+
+        for pump in pumps:
+            pump.start()
+
+        for chunk in iter(lambda: proc.stdout.read1(65536), b''):
+            channel.sendall(chunk)
+
+        proc.wait()
+        pumps[1].join()
+
+        channel.send_exit_status(proc.returncode)
+        channel.close()
+
+
+def serve(root: Path, env: dict) -> int:
+    """Serve SSH on an ephemeral port on every local address, returning the port"""
+    host_key = paramiko.RSAKey.generate(bits=2048)
+
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', 0))
+    sock.listen(64)
+
+    def accept():
+        while True:
+            conn, _ = sock.accept()
+
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', SFTPServer, RootSFTP)
+
+            server = StandInServer(root, env)
+            transport.start_server(server=server)
+
+    threading.Thread(target=accept, daemon=True).start()
+
+    return sock.getsockname()[1]
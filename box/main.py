@@ -3,13 +3,19 @@
 """Mystery-Box: The Box! The Box!
 
 Usage:
-  box up [--config <str>]
-  box in [--user <user>] [--config <str>]
-  box configure [--playbook <str>]
-  box start
-  box stop
-  box delete
-  box ip
+  box up [--config <str>] [--force] [--golden] [--count <n>] [--name-prefix <str>] [--concurrency <n>] [--profile <file>]
+  box in [--user <user>] [--config <str>] [--cmd <str>]
+  box configure [--playbook <str>] [--config <str>] [--force] [--changed-only | --all] [--profile <file>]
+  box start [--config <str>] [--name-prefix <str>]
+  box stop [--name-prefix <str>]
+  box suspend [--name-prefix <str>]
+  box resume [--name-prefix <str>]
+  box delete [--name-prefix <str>]
+  box ip [--name-prefix <str>]
+  box stats [--last <n>]
+  box pool fill [--config <str>] [--size <n>] [--wait]
+  box pool drain
+  box daemon [--idle-suspend <m>]
   box (-h|--help)
 
 Description:
@@ -27,37 +33,188 @@ Options:
   --memory <memory>    the RAM memory to provision the instances with. [default: 3G]
   --disk <disk>        the disk-space to provision the instances with. [default: 30G]
   --backend <backend>  which technology should be used to host the development box? [default: multipass]
+  --cmd <str>          run a single command on the instance, over the shared SSH connection, instead of a shell.
   --playbook <str>     path to an Ansible playbook for provisioning this instance.
+  --force              upload every copy entry and playbook, even if the instance already has them.
+  --changed-only       only apply playbooks whose fingerprint changed since they were last applied. This is the default.
+  --all                apply every playbook, even if it is unchanged since it was last applied.
+  --golden             clone the instance from a cached, already bootstrapped golden image.
+  --count <n>          provision a fleet of n identical instances, named <prefix>-1 to <prefix>-n.
+  --name-prefix <str>  the fleet name prefix. start, stop, delete and ip act on every instance in the fleet.
+  --concurrency <n>    how many fleet instances are provisioned at once. [default: 4]
+  --profile <file>     write a Chrome trace-event JSON profile of the run, including each Ansible task, to file.
+  --last <n>           how many recent runs box stats summarises. [default: 50]
+  --size <n>           how many spare instances the warm pool keeps for this configuration. [default: 2]
+  --idle-suspend <m>   suspend boxes that have had no login sessions and little load for m minutes.
+  --wait               fill the warm pool in the foreground, rather than in a background process.
   -h,--help            show this documentation
 """
 
+import sys
+import time
 from docopt import docopt
-from src.box import hardware_backends
+
+# -- each command imports only what it uses, so `box ip`, `box stop` and friends
+# -- start without loading the SSH and provisioning stack
 
 def main():
-    """Call the correct CLI command"""
+    """Call the correct CLI command, recording its timings and writing a profile of it if requested"""
 
     args = docopt(__doc__, version='Box 1.0')
 
+    if args['stats']:
+        from src.box.history import History
+        print(History().report(int(args['--last'])))
+        return
+
+    if not args['up'] and not args['configure']:
+        run(args)
+        return
+
+    from src.box.tracing import Tracer
+    from src.box.history import History
+
+    Tracer.detailed = bool(args['--profile'])
+    start_time = time.monotonic()
+    status = 'failed'
+
+    try:
+        run(args)
+        status = 'ok'
+    except SystemExit as err:
+        status = 'ok' if not err.code else 'failed'
+        raise
+    finally:
+        History().record('up' if args['up'] else 'configure', args['--name-prefix'] or 'devbox',
+                         status, time.monotonic() - start_time, Tracer.spans())
+
+        if args['--profile']:
+            Tracer.export(args['--profile'])
+            print(f'📦 profile written to {args["--profile"]}')
+
+def run(args):
+    """Call the correct CLI command"""
+
+    if args['--count'] or args['--name-prefix']:
+        fleet_main(args)
+        return
+
+    if args['pool']:
+        pool_main(args)
+        return
+
+    if not args['--profile']:
+        status = daemon_main(args)
+
+        if status is not None:
+            if status:
+                exit(status)
+            return
+
+    from src.box import hardware_backends
+
     vm = hardware_backends.DevBoxProvisioner.multipass('devbox')
 
     if args['up']:
-        vm.up()
+        vm.up({
+            'config': args['--config'],
+            'force': args['--force'],
+            'golden': args['--golden']
+        })
     elif args['in']:
         vm.into({
             'user': args['--user'],
-            'config': args['--config']
+            'config': args['--config'],
+            'cmd': args['--cmd']
         })
     elif args['stop']:
         vm.stop()
     elif args['start']:
-        vm.start()
+        vm.start({'config': args['--config']})
+    elif args['suspend']:
+        vm.suspend()
+    elif args['resume']:
+        vm.resume()
     elif args['configure']:
-        vm.configure(args['--playbook'])
+        cfg = vm.load_config(args['--config'])
+
+        if args['--playbook']:
+            cfg.playbooks = [args['--playbook']]
+
+        vm.configure(cfg, {
+            'force': args['--force'],
+            'all': args['--all']
+        })
     elif args['delete']:
         vm.delete()
     elif args['ip']:
         print(vm.ip())
+    elif args['daemon']:
+        from src.box.daemon import Daemon
+        idle_suspend = args['--idle-suspend']
+        Daemon('devbox', float(idle_suspend) * 60 if idle_suspend else None).run()
+
+def daemon_main(args):
+    """Pass ip, in and configure to a running box daemon. Returns the exit status, or None if no daemon is running"""
+    from src.box.daemon import DaemonClient
+
+    if args['ip']:
+        return DaemonClient.request('ip', {})
+    elif args['in']:
+        return DaemonClient.request('in', {
+            'user': args['--user'],
+            'config': args['--config'],
+            'cmd': args['--cmd']
+        })
+    elif args['configure']:
+        return DaemonClient.request('configure', {
+            'playbook': args['--playbook'],
+            'config': args['--config'],
+            'force': args['--force'],
+            'all': args['--all']
+        })
+
+    return None
+
+def pool_main(args):
+    """Fill or drain the warm pool of spare instances"""
+    from src.box.pool import WarmPool
+
+    if args['drain']:
+        WarmPool.drain()
+    elif not args['--wait']:
+        WarmPool.detach(sys.argv)
+    else:
+        from src.box.hardware_backends import DevBoxMultipass
+
+        vm = DevBoxMultipass('devbox')
+        vm.fill_pool(vm.load_config(args['--config']), int(args['--size']))
+
+def fleet_main(args):
+    """Call the correct CLI command against every instance in a fleet"""
+    from src.box.fleet import Fleet
+
+    fleet = Fleet(args['--name-prefix'] or 'devbox', int(args['--concurrency']))
+
+    if args['up']:
+        fleet.up(int(args['--count'] or 1), {
+            'config': args['--config'],
+            'force': args['--force'],
+            'golden': args['--golden']
+        })
+    elif args['stop']:
+        fleet.stop()
+    elif args['start']:
+        fleet.start({'config': args['--config']})
+    elif args['suspend']:
+        fleet.suspend()
+    elif args['resume']:
+        fleet.resume()
+    elif args['delete']:
+        fleet.delete()
+    elif args['ip']:
+        for name, ip in fleet.ips().items():
+            print(f'{name} {ip}')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,391 @@
+
+import os
+import re
+import sys
+import errno
+import socket
+import shutil
+import subprocess
+import http.client
+import posixpath
+import ipaddress
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from typing import Optional, Union
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .utils import logging, cache_dir
+
+PYPI_INDEX = 'https://pypi.org/simple'
+PYPI_FILES = 'https://files.pythonhosted.org'
+
+# -- the host-side bridge Multipass attaches instances to, by platform and driver
+BRIDGES = {
+    'linux': ['mpqemubr0', 'mpbr0'],
+    'darwin': ['bridge100']
+}
+
+APT_CONF = '/etc/apt/apt.conf.d/01mystery-box'
+PIP_CONF = '/etc/xdg/pip/pip.conf'
+
+# -- run on the instance; points apt and pip at the host's cache when it answers, and otherwise
+# -- removes the configuration, so an instance provisioned while box was serving keeps working without it
+SETUP_SCRIPT = """GW=$(ip route | awk '/^default/ {{print $3; exit}}')
+if [ -n "$GW" ] && curl -sf --max-time 2 "http://$GW:{port}/ping" >/dev/null; then
+  echo "Acquire::http::Proxy \\"http://$GW:{port}\\";" > {apt_conf}
+  mkdir -p {pip_folder}
+  printf '[global]\\nindex-url = http://%s:{port}/pypi/simple/\\ntrusted-host = %s\\n' "$GW" "$GW" > {pip_conf}
+else
+  rm -f {apt_conf} {pip_conf}
+fi"""
+
+TEARDOWN_SCRIPT = f'rm -f {APT_CONF} {PIP_CONF}'
+
+
+def setup_script(port: int) -> str:
+    return SETUP_SCRIPT.format(port=port, apt_conf=APT_CONF, pip_conf=PIP_CONF,
+                               pip_folder=posixpath.dirname(PIP_CONF))
+
+
+class ArtifactHandler(BaseHTTPRequestHandler):
+    """Serve apt as a caching HTTP proxy, and pip as a caching mirror of the PyPI simple index.
+    Packages are content-addressed, so once cached they are served without asking upstream; indices
+    are refreshed on every request, and served from the cache when upstream is unreachable"""
+
+    def do_GET(self) -> None:
+        if ipaddress.ip_address(self.client_address[0]) not in ArtifactCache.bridge.network:
+            self.send_error(403)
+            return
+
+        if self.path == '/ping':
+            self.send_content(b'ok', 'text/plain')
+        elif self.path.startswith('http://'):
+            self.apt()
+        elif self.path.startswith('/pypi/simple/'):
+            self.pypi_index()
+        elif self.path.startswith('/pypi/files/'):
+            self.pypi_file()
+        else:
+            self.send_error(404)
+
+    def apt(self) -> None:
+        url = self.path.split('?')[0]
+        address = ArtifactCache.upstream(url)
+
+        if address is None:
+            self.send_error(403)
+            return
+
+        # -- a port separator cannot appear in Windows file names
+        fpath = ArtifactCache.path('apt', url[len('http://'):].replace(':', '_'))
+
+        # -- archives and by-hash indices never change under the same URL
+        immutable = url.endswith(('.deb', '.udeb', '.dsc')) or '/by-hash/' in url
+
+        self.send_cached(url, fpath, immutable, 'application/octet-stream', address=address)
+
+    def pypi_index(self) -> None:
+        project = self.path[len('/pypi/simple/'):].split('?')[0].strip('/').lower()
+
+        if not re.fullmatch(r'[a-z0-9._-]+', project):
+            self.send_error(404)
+            return
+
+        fpath = ArtifactCache.path('pypi', 'simple', f'{project}.html')
+        self.send_cached(f'{PYPI_INDEX}/{project}/', fpath, False, 'text/html', rewrite=True)
+
+    def pypi_file(self) -> None:
+        relative = self.path[len('/pypi/files/'):].split('?')[0].split('#')[0]
+        fpath = ArtifactCache.path('pypi', 'files', relative)
+
+        self.send_cached(f'{PYPI_FILES}/{relative}', fpath, True, 'application/octet-stream')
+
+    def send_cached(self, url: str, fpath: Optional[Path], immutable: bool, content_type: str,
+                    rewrite: bool = False, address: Optional[str] = None) -> None:
+        if fpath is None:
+            self.send_error(404)
+            return
+
+        if rewrite:
+            # -- indices are small, so they are rewritten in memory to route package downloads back through this cache
+            status = ArtifactCache.fetch(url, fpath, immutable, address)
+
+            if status != 200:
+                self.send_error(status)
+                return
+
+            with open(fpath, 'rb') as conn:
+                content = conn.read().replace(f'{PYPI_FILES}/'.encode('utf8'), b'/pypi/files/')
+
+            self.send_content(content, content_type)
+            return
+
+        if immutable and fpath.exists():
+            self.send_file(fpath, content_type)
+            return
+
+        try:
+            response = ArtifactCache.open(url, address)
+        except urllib.error.HTTPError as err:
+            self.send_error(err.code)
+            return
+        except (urllib.error.URLError, OSError) as err:
+            if not fpath.exists():
+                logging.warning(f'📦 could not fetch {url}, and it is not cached: {err}')
+                self.send_error(502)
+                return
+
+            logging.info(f'📦 could not fetch {url}; serving the cached copy')
+            self.send_file(fpath, content_type)
+            return
+
+        with response:
+            self.send_upstream(url, response, fpath, content_type)
+
+    def send_upstream(self, url: str, response, fpath: Path, content_type: str) -> None:
+        """Send an upstream response to the instance as it arrives, caching it at the same time, so large
+        packages are neither held in memory nor downloaded in full before the instance sees a byte"""
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+
+        if response.headers.get('Content-Length'):
+            self.send_header('Content-Length', response.headers['Content-Length'])
+
+        self.end_headers()
+
+        partial = ArtifactCache.partial(fpath)
+        sending = True
+        received = 0
+
+        try:
+            fpath.parent.mkdir(parents=True, exist_ok=True)
+
+            with open(partial, 'wb') as conn:
+                while chunk := response.read(ArtifactCache.chunk_size):
+                    conn.write(chunk)
+                    received += len(chunk)
+
+                    if not sending:
+                        continue
+
+                    # -- the download is still cached if the instance gives up on it
+                    try:
+                        self.wfile.write(chunk)
+                    except OSError:
+                        sending = False
+
+            ArtifactCache.check_length(response, received)
+            os.replace(partial, fpath)
+        except (OSError, http.client.HTTPException) as err:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+            # -- the status line is already sent, so the instance only learns of the failure from the connection closing
+            logging.warning(f'📦 could not fetch {url}: {err}')
+            self.close_connection = True
+
+    def send_file(self, fpath: Path, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(os.stat(fpath).st_size))
+        self.end_headers()
+
+        with open(fpath, 'rb') as conn:
+            shutil.copyfileobj(conn, self.wfile, ArtifactCache.chunk_size)
+
+    def send_content(self, content: bytes, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class RefuseRedirects(urllib.request.HTTPRedirectHandler):
+    """Pass redirects back to apt rather than following them, so they are checked like any other request"""
+
+    def redirect_request(self, *args, **kwargs) -> None:
+        return None
+
+
+class ArtifactCache:
+    """A host-side cache of the apt packages and Python packages instances install, served to them over
+    HTTP while box provisions them. Every instance after the first installs from the host rather than
+    the internet, and once the cache is warm, provisioning works offline"""
+    port: int = 3149
+    timeout: float = 30.0
+    chunk_size: int = 1024 * 1024
+
+    server: Optional[ThreadingHTTPServer] = None
+    bridge: Optional[ipaddress.IPv4Interface] = None
+    lock = threading.Lock()
+    opener = urllib.request.build_opener(RefuseRedirects)
+
+    @staticmethod
+    def folder() -> Path:
+        folder = cache_dir() / 'artifacts'
+        folder.mkdir(exist_ok=True)
+
+        return folder
+
+    @staticmethod
+    def path(*parts: str) -> Optional[Path]:
+        """The cache path for a URL path, or None if it would escape the cache folder"""
+        relative = '/'.join(parts)
+
+        if '..' in relative.split('/'):
+            return None
+
+        relative = posixpath.normpath(relative).lstrip('/')
+
+        return ArtifactCache.folder() / relative if relative else None
+
+    @staticmethod
+    def upstream(url: str) -> Optional[str]:
+        """The address to fetch a proxied apt URL from, or None if the proxy must not reach it.
+        Only plain HTTP on port 80 to public addresses is proxied, so instances cannot use the cache
+        to reach the host's own services or the host's local network"""
+        try:
+            parts = urllib.parse.urlsplit(url)
+            port = parts.port
+        except ValueError:
+            return None
+
+        if parts.scheme != 'http' or not parts.hostname or port not in (None, 80):
+            return None
+
+        try:
+            infos = socket.getaddrinfo(parts.hostname, 80, type=socket.SOCK_STREAM)
+        except OSError:
+            return None
+
+        addresses = [ipaddress.ip_address(info[4][0].split('%')[0]) for info in infos]
+
+        if not addresses or not all(address.is_global for address in addresses):
+            return None
+
+        return str(addresses[0])
+
+    @staticmethod
+    def partial(fpath: Path) -> Path:
+        """A download's temporary path, unique to the thread downloading it"""
+        return fpath.with_name(f'{fpath.name}.{threading.get_ident()}.partial')
+
+    @staticmethod
+    def open(url: str, address: Optional[str] = None):
+        """Request url from upstream. If an address is given, the request is sent to it, so the host
+        name is not resolved again once it is checked"""
+        request: Union[str, urllib.request.Request] = url
+
+        if address:
+            parts = urllib.parse.urlsplit(url)
+            netloc = f'[{address}]' if ':' in address else address
+            netloc += f':{parts.port}' if parts.port else ''
+            request = urllib.request.Request(parts._replace(netloc=netloc).geturl(), headers={'Host': parts.netloc})
+
+        # -- apt requests are not redirected, as the target of a redirect would not be checked
+        open_url = ArtifactCache.opener.open if address else urllib.request.urlopen
+
+        return open_url(request, timeout=ArtifactCache.timeout)
+
+    @staticmethod
+    def check_length(response, received: int) -> None:
+        """Raise if upstream closed the connection before sending the whole body, as reads do not"""
+        expected = response.headers.get('Content-Length')
+
+        if expected and expected.isdigit() and received != int(expected):
+            raise http.client.IncompleteRead(b'', int(expected) - received)
+
+    @staticmethod
+    def fetch(url: str, fpath: Path, immutable: bool, address: Optional[str] = None) -> int:
+        """Make sure fpath holds the content at url, returning an HTTP status"""
+        if immutable and fpath.exists():
+            return 200
+
+        partial = ArtifactCache.partial(fpath)
+
+        try:
+            with ArtifactCache.open(url, address) as response:
+                fpath.parent.mkdir(parents=True, exist_ok=True)
+
+                with open(partial, 'wb') as conn:
+                    shutil.copyfileobj(response, conn)
+
+                ArtifactCache.check_length(response, os.path.getsize(partial))
+
+            os.replace(partial, fpath)
+        except urllib.error.HTTPError as err:
+            return err.code
+        except (urllib.error.URLError, OSError, http.client.HTTPException) as err:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+            if not fpath.exists():
+                logging.warning(f'📦 could not fetch {url}, and it is not cached: {err}')
+                return 502
+
+            logging.info(f'📦 could not fetch {url}; serving the cached copy')
+
+        return 200
+
+    @staticmethod
+    def find_bridge() -> Optional[ipaddress.IPv4Interface]:
+        """The host's address on the Multipass bridge, which is the gateway instances reach it by"""
+        for name in BRIDGES.get(sys.platform, []):
+            if sys.platform == 'darwin':
+                argv = ['ifconfig', name]
+            else:
+                argv = ['ip', '-4', '-o', 'addr', 'show', 'dev', name]
+
+            try:
+                proc = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            except FileNotFoundError:
+                continue
+
+            # -- ip prints 10.0.0.1/24, and ifconfig prints 10.0.0.1 netmask 0xffffff00
+            match = re.search(r'inet (\d+\.\d+\.\d+\.\d+)(?:/(\d+)| netmask (0x[0-9a-f]+))', proc.stdout)
+
+            if proc.returncode == 0 and match:
+                address, prefix, netmask = match.groups()
+                prefix = prefix or str(bin(int(netmask, 16)).count('1'))
+
+                return ipaddress.IPv4Interface(f'{address}/{prefix}')
+
+        return None
+
+    @classmethod
+    def serve(cls) -> None:
+        """Start serving the cache on the Multipass bridge, unless it is already served"""
+        with cls.lock:
+            if cls.server:
+                return
+
+            bridge = cls.find_bridge()
+
+            # -- instances then provision from upstream, as they would without the cache
+            if bridge is None:
+                logging.warning('📦 could not find the Multipass bridge; not serving the artifact cache')
+                return
+
+            try:
+                server = ThreadingHTTPServer((str(bridge.ip), cls.port), ArtifactHandler)
+            except OSError as err:
+                if err.errno != errno.EADDRINUSE:
+                    raise
+
+                # -- another box process is serving the same cache folder
+                logging.info(f'📦 artifact cache port {cls.port} is in use; assuming another box process serves it')
+                return
+
+            cls.bridge = bridge
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+            cls.server = server
+            logging.info(f'📦 serving the artifact cache in {cls.folder()} on {bridge.ip}:{cls.port}')
@@ -3,17 +3,31 @@ import os
 from typing import Optional
 from pathlib import Path
 
+# -- each transfer worker opens an SFTP session on the box's one connection, beside the pooled SFTP
+# -- session and checksum commands; OpenSSH allows 10 sessions per connection by default
+MAX_TRANSFER_WORKERS = 8
+
 
 class BoxConfig:
     """A dataclass for box-configuration, that validates each provided argument."""
 
-    def __init__(self, user: str, memory: str, disk: str, playbooks: list[str], copy: Optional[list[dict]], key_folder: Path) -> None:
+    def __init__(self, user: str, memory: str, disk: str, playbooks: list[str], copy: Optional[list[dict]], key_folder: Path,
+                 transfer_workers: int = 4, vars: Optional[dict] = None, single_session: bool = False,
+                 key_type: Optional[str] = None, preseed_threshold: int = 0,
+                 artifact_cache: bool = False, configurator: str = 'bootstrap') -> None:
         self.user = user
         self.memory = memory
         self.disk = disk
         self.playbooks = playbooks
         self.copy = copy
         self.key_folder = key_folder
+        self.transfer_workers = transfer_workers
+        self.vars = vars
+        self.single_session = single_session
+        self.key_type = key_type
+        self.preseed_threshold = preseed_threshold
+        self.artifact_cache = artifact_cache
+        self.configurator = configurator
 
     @property
     def user(self):
@@ -75,6 +89,95 @@ class BoxConfig:
 
         self._key_folder = Path(value)
 
+    @property
+    def transfer_workers(self):
+        return self._transfer_workers
+
+    @transfer_workers.setter
+    def transfer_workers(self, value):
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise TypeError('transfer_workers must be an integer')
+
+        if value < 1:
+            raise ValueError('transfer_workers must be at least 1')
+
+        if value > MAX_TRANSFER_WORKERS:
+            raise ValueError(f'transfer_workers must be at most {MAX_TRANSFER_WORKERS}')
+
+        self._transfer_workers = value
+
+    @property
+    def vars(self):
+        return self._vars
+
+    @vars.setter
+    def vars(self, value):
+        if value is None:
+            value = {}
+
+        if not isinstance(value, dict):
+            raise TypeError('vars must be a dictionary')
+
+        self._vars = value
+
+    @property
+    def single_session(self):
+        return self._single_session
+
+    @single_session.setter
+    def single_session(self, value):
+        if not isinstance(value, bool):
+            raise TypeError('single_session must be a boolean')
+
+        self._single_session = value
+
+    @property
+    def key_type(self):
+        return self._key_type
+
+    @key_type.setter
+    def key_type(self, value):
+        if value is not None and value not in ('ed25519', 'rsa'):
+            raise ValueError('key_type must be one of ed25519, rsa')
+
+        self._key_type = value
+
+    @property
+    def preseed_threshold(self):
+        return self._preseed_threshold
+
+    @preseed_threshold.setter
+    def preseed_threshold(self, value):
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise TypeError('preseed_threshold must be an integer')
+
+        if value < 0:
+            raise ValueError('preseed_threshold must not be negative')
+
+        self._preseed_threshold = value
+
+    @property
+    def artifact_cache(self):
+        return self._artifact_cache
+
+    @artifact_cache.setter
+    def artifact_cache(self, value):
+        if not isinstance(value, bool):
+            raise TypeError('artifact_cache must be a boolean')
+
+        self._artifact_cache = value
+
+    @property
+    def configurator(self):
+        return self._configurator
+
+    @configurator.setter
+    def configurator(self, value):
+        if value not in ('bootstrap', 'push'):
+            raise ValueError('configurator must be one of bootstrap, push')
+
+        self._configurator = value
+
     @property
     def copy(self):
         return self._copy
@@ -107,9 +210,31 @@ class BoxConfig:
                     raise TypeError(
                         f'dict entry #{idx} dest entry was not a string')
 
+                if not isinstance(entry.get('compress', False), bool):
+                    raise TypeError(
+                        f'dict entry #{idx} compress entry was not a boolean')
+
+                mode = entry.get('mode', 'copy')
+
+                if mode not in ('copy', 'mount'):
+                    raise ValueError(
+                        f'dict entry #{idx} mode entry must be one of copy, mount')
+                elif mode == 'mount' and not os.path.isdir(entry['src']):
+                    raise ValueError(
+                        f'dict entry #{idx} is mounted, so its src must be a directory')
+
                 processed.append({
                     'src': Path(entry['src']),
-                    'dest': Path(entry['dest'])
+                    'dest': Path(entry['dest']),
+                    'compress': entry.get('compress', False),
+                    'mode': mode
                 })
 
             self._copy = processed
+        else:
+            self._copy = []
+
+    @property
+    def mounts(self):
+        """The copy entries mounted into the instance, rather than copied"""
+        return [entry for entry in self._copy if entry['mode'] == 'mount']
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
 from abc import ABC, abstractmethod
+import os
+import stat
+import base64
 import yaml
 from pathlib import Path
+from typing import Optional
 
 from .ssh import SSH
+from .artifacts import setup_script, TEARDOWN_SCRIPT
 
 
 class CloudInit(ABC):
@@ -35,17 +40,46 @@ class BootstrappingCloudInit(CloudInit):
 
     cfg: dict
 
-    def __init__(self, user: str, folder: Path) -> None:
+    def __init__(self, user: str, folder: Path, key_type: Optional[str] = None,
+                 preseed: Optional[list[dict]] = None, artifact_port: Optional[int] = None,
+                 install_ansible: bool = True) -> None:
         self.user = user
+        self.install_ansible = install_ansible
+        self.key_type = key_type
+        self.preseed = preseed or []
+        self.artifact_port = artifact_port
         self.cfg = self.create_config(folder)
 
+    @staticmethod
+    def preseedable(entries: list[dict], threshold: int) -> list[dict]:
+        """Select the copy entries that are files no larger than threshold bytes"""
+        return [entry for entry in entries
+                if entry['mode'] == 'copy' and os.path.isfile(entry['src']) and os.path.getsize(entry['src']) <= threshold]
+
+    @staticmethod
+    def preseed_file(entry: dict) -> dict:
+        """A write_files entry holding a copy entry's content and permissions. Relative destinations are
+        relative to root's home, as they are for uploads; files are written once users are created"""
+        dest = Path(entry['dest'])
+
+        with open(entry['src'], 'rb') as conn:
+            content = base64.b64encode(conn.read()).decode('ascii')
+
+        return {
+            'path': str(dest if dest.is_absolute() else Path('/root') / dest),
+            'encoding': 'b64',
+            'content': content,
+            'permissions': f"{stat.S_IMODE(os.stat(entry['src']).st_mode):04o}",
+            'defer': True
+        }
+
     def create_config(self, folder: Path) -> dict:
         """Create minimal cloud-init configuration"""
 
-        ssh_public_path, _ = SSH.save_keypair(folder)
+        ssh_public_path, _ = SSH.save_keypair(folder, self.key_type)
         ssh_keys = self.read_public_keys([ssh_public_path])
 
-        return {
+        cfg = {
             'users': [
                 {
                     'name': 'root',
@@ -58,20 +92,32 @@ class BootstrappingCloudInit(CloudInit):
                     'sudo': ['ALL=(ALL) NOPASSWD: ALL']
                 }
             ],
-            'packages': [
-                'python3-pip'
-            ],
-            'runcmd': [
-                'sudo pip3 install ansible'
-            ],
+            'runcmd': [],
             'write_files': [
                 {
                     'path': '/etc/environment',
                     'content': 'LANG=en_US.utf-8\nLC_ALL=en_US.utf-8\n'
-                }
+                },
+                *[BootstrappingCloudInit.preseed_file(entry) for entry in self.preseed]
             ]
         }
 
+        if self.install_ansible:
+            cfg['packages'] = ['python3-pip']
+
+            # -- skipped on instances cloned from an already-bootstrapped golden image
+            cfg['runcmd'].append('command -v ansible-playbook >/dev/null || sudo pip3 install ansible')
+
+        if self.artifact_port:
+            # -- install packages through the host's artifact cache during bootstrap, then stop using it.
+            # -- bootcmd runs on every boot but runcmd only on an instance's first, so the setup is limited
+            # -- to the first boot too, or a reboot would leave the instance using the cache
+            cfg['bootcmd'] = [['cloud-init-per', 'instance', 'mystery-box-artifacts',
+                               'sh', '-c', setup_script(self.artifact_port)]]
+            cfg['runcmd'].append(TEARDOWN_SCRIPT)
+
+        return cfg
+
     def to_yaml(self) -> str:
         """Convert Cloud-Init configuration to YAML"""
         return yaml.dump(self.cfg)
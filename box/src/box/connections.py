@@ -0,0 +1,120 @@
+
+import atexit
+import logging
+import threading
+from pathlib import Path
+import paramiko
+
+from .keys import KeyManager
+from .tracing import Tracer
+
+
+class ConnectionPool:
+    """Share one authenticated SSH transport per (user, ip, key) across SSH and SCP.
+    Channels (exec, sftp) are multiplexed over the pooled transport, so a whole `box up`
+    pays for a single handshake per host."""
+    clients: dict = {}
+    sftp_sessions: dict = {}
+    locks: dict = {}
+    # -- connect and reuse counts by host, so concurrent configures of a fleet count separately
+    stats: dict = {}
+    lock = threading.Lock()
+
+    # -- instances listen on the standard port; overridden to reach local stand-in servers
+    port: int = 22
+
+    @classmethod
+    def key_lock(cls, key: tuple) -> threading.Lock:
+        with cls.lock:
+            return cls.locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def is_active(client: paramiko.SSHClient) -> bool:
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    @classmethod
+    def client(cls, user: str, ip: str, key_path: Path) -> paramiko.SSHClient:
+        """Retrieve a connected client for this host, connecting only if no live transport exists"""
+        key = (user, ip, str(key_path))
+
+        with cls.key_lock(key):
+            client = cls.clients.get(key)
+
+            counts = cls.stats.setdefault(ip, {'connects': 0, 'reuses': 0})
+
+            if client and cls.is_active(client):
+                counts['reuses'] += 1
+                return client
+
+            logging.getLogger("paramiko").setLevel(logging.WARNING)
+
+            pkey = KeyManager.private_key(key_path)
+
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+            with Tracer.span('ssh connect', ip=ip):
+                client.connect(ip, port=cls.port, username=user, pkey=pkey)
+
+            client.get_transport().set_keepalive(30)
+
+            cls.clients[key] = client
+            counts['connects'] += 1
+
+            return client
+
+    @classmethod
+    def sftp(cls, user: str, ip: str, key_path: Path) -> paramiko.SFTPClient:
+        """Retrieve an SFTP session on the pooled transport, opening a channel only when needed.
+        SFTP sessions are not thread-safe, so each thread is given its own channel"""
+        client = cls.client(user, ip, key_path)
+        key = (user, ip, str(key_path))
+        session_key = (*key, threading.get_ident())
+
+        with cls.key_lock(key):
+            sftp = cls.sftp_sessions.get(session_key)
+
+            if sftp is None or sftp.get_channel().closed:
+                sftp = client.open_sftp()
+                cls.sftp_sessions[session_key] = sftp
+
+            return sftp
+
+    @classmethod
+    def reset_stats(cls, ip: str) -> None:
+        cls.stats[ip] = {'connects': 0, 'reuses': 0}
+
+    @classmethod
+    def summary(cls, ip: str) -> str:
+        counts = cls.stats.get(ip, {'connects': 0, 'reuses': 0})
+        connects = counts['connects']
+        reuses = counts['reuses']
+
+        return f'{connects} ssh connects, {reuses} reused'
+
+    @classmethod
+    def forget(cls, ip: str) -> None:
+        """Close the pooled SFTP sessions and transports to one host, such as an instance being suspended"""
+        with cls.lock:
+            for key in [key for key in cls.sftp_sessions if key[1] == ip]:
+                cls.sftp_sessions.pop(key).close()
+
+            for key in [key for key in cls.clients if key[1] == ip]:
+                cls.clients.pop(key).close()
+
+    @classmethod
+    def close(cls) -> None:
+        """Close every pooled SFTP session and transport"""
+        with cls.lock:
+            for sftp in cls.sftp_sessions.values():
+                sftp.close()
+
+            for client in cls.clients.values():
+                client.close()
+
+            cls.sftp_sessions = {}
+            cls.clients = {}
+
+
+atexit.register(ConnectionPool.close)
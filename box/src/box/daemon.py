@@ -0,0 +1,356 @@
+
+import io
+import os
+import sys
+import copy
+import time
+import json
+import socket
+import threading
+import subprocess
+import socketserver
+from pathlib import Path
+from typing import Optional
+from contextlib import redirect_stdout, redirect_stderr
+
+from .utils import logging, cache_dir
+
+# -- requests and replies are newline-delimited JSON. A reply is a series of
+# -- {"stream": "stdout" | "stderr", "data": str} messages, then {"exit": int},
+# -- optionally preceded by {"argv": [...]}, a command the client should run itself.
+
+
+def socket_path() -> Path:
+    return cache_dir() / 'daemon.sock'
+
+
+class DaemonClient:
+    """Send CLI commands to a running `box daemon`. Kept free of heavy imports, so a
+    command served by the daemon starts as quickly as possible"""
+
+    @staticmethod
+    def connect() -> Optional[socket.socket]:
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path()):
+            return None
+
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            conn.connect(str(socket_path()))
+        except OSError:
+            conn.close()
+            return None
+
+        return conn
+
+    @staticmethod
+    def request(command: str, args: dict) -> Optional[int]:
+        """Run a command through the daemon, returning its exit status, or None if no daemon is listening"""
+        conn = DaemonClient.connect()
+
+        if conn is None:
+            return None
+
+        status = 1
+        argv_status = None
+
+        with conn, conn.makefile('rwb') as stream:
+            stream.write(json.dumps({'command': command, 'args': args, 'cwd': os.getcwd()}).encode('utf8') + b'\n')
+            stream.flush()
+
+            for line in stream:
+                message = json.loads(line)
+
+                if 'stream' in message:
+                    output = sys.stderr if message['stream'] == 'stderr' else sys.stdout
+                    output.write(message['data'])
+                    output.flush()
+                elif 'argv' in message:
+                    argv_status = subprocess.run(message['argv']).returncode
+                elif 'exit' in message:
+                    status = message['exit'] if argv_status is None else argv_status
+
+        return status
+
+
+class ReplyStream(io.TextIOBase):
+    """A text stream that forwards each write to the client as a reply message"""
+
+    def __init__(self, wfile, name: str) -> None:
+        self.wfile = wfile
+        self.name = name
+
+    def write(self, data: str) -> int:
+        self.wfile.write(json.dumps({'stream': self.name, 'data': data}).encode('utf8') + b'\n')
+        self.wfile.flush()
+        return len(data)
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        request = json.loads(self.rfile.readline())
+        status = 0
+
+        try:
+            status = self.server.daemon.serve(request, self.wfile)
+        except SystemExit as err:
+            status = err.code if isinstance(err.code, int) else 1
+        except Exception as err:
+            ReplyStream(self.wfile, 'stderr').write(f'📦 {type(err).__name__}: {err}\n')
+            status = 1
+
+        self.wfile.write(json.dumps({'exit': status}).encode('utf8') + b'\n')
+
+
+class Daemon:
+    """A resident process that keeps SSH transports, the multipass snapshot and parsed box.yaml
+    files warm between CLI invocations. It serves `box ip`, `box in` and `box configure`
+    over a Unix socket in the cache folder, and optionally suspends idle boxes"""
+    configs: dict
+    idle_since: dict
+    refresh_interval: float = 5.0
+
+    # -- how often boxes are checked for idleness, and the one-minute load average below which a box is idle
+    idle_interval: float = 60.0
+    idle_load: float = 0.25
+
+    def __init__(self, name: str, idle_timeout: Optional[float] = None) -> None:
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self.configs = {}
+        self.idle_since = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def vm(self):
+        from .hardware_backends import DevBoxProvisioner
+        return DevBoxProvisioner.multipass(self.name)
+
+    def config(self, fpath: Path):
+        """Parse a box.yaml, reusing the parsed configuration until the file changes"""
+        mtime = os.path.getmtime(fpath)
+        cached = self.configs.get(str(fpath))
+
+        if cached and cached[0] == mtime:
+            return copy.copy(cached[1])
+
+        logging.info(f'📦 loading {fpath}')
+        cfg = self.vm().load_config(str(fpath))
+        self.configs[str(fpath)] = (mtime, cfg)
+
+        return copy.copy(cfg)
+
+    @staticmethod
+    def reload() -> None:
+        """Take a new instance snapshot, closing transports to instances that stopped, were suspended
+        or changed address since the last one"""
+        from .multipass import Multipass
+        from .connections import ConnectionPool
+
+        previous = Multipass.state or {}
+
+        Multipass.invalidate()
+        current = Multipass.snapshot()
+
+        for name, inst in previous.items():
+            changed = current.get(name, {})
+
+            if changed.get('state') != inst.get('state') or changed.get('ipv4') != inst.get('ipv4'):
+                for ip in inst.get('ipv4') or []:
+                    ConnectionPool.forget(ip)
+
+    def sync(self) -> None:
+        """Reload the instance snapshot if a CLI process changed an instance since it was taken, as
+        `box stop` and `box suspend` run outside the daemon"""
+        from .multipass import Multipass
+
+        if Multipass.state is None or Multipass.outdated():
+            self.reload()
+
+    @staticmethod
+    def forget_run() -> None:
+        """Drop the trace spans and file fingerprints recorded so far. Both are only needed within one
+        run, and would otherwise grow for as long as the daemon runs"""
+        from .tracing import Tracer
+        from .manifest import Manifest
+
+        Tracer.reset()
+        Manifest.reset()
+
+    def refresh(self) -> None:
+        """Keep the instance snapshot fresh, so changes made outside box are noticed"""
+        while not self.stopped.wait(self.refresh_interval):
+            try:
+                with self.lock:
+                    self.forget_run()
+                    self.reload()
+            except Exception as err:
+                logging.warning(f'📦 could not refresh instance state: {err}')
+
+    def idle(self, name: str) -> Optional[bool]:
+        """Is a box free of ssh connections and load? None if it is not running, or box cannot log into it"""
+        from .ssh_config import SSHConfig
+        from .connections import ConnectionPool
+        from .hardware_backends import DevBoxMultipass
+
+        ipv4 = DevBoxMultipass(name).ip()
+        key_path = SSHConfig(name).identity()
+
+        if not ipv4 or not key_path:
+            return None
+
+        client = ConnectionPool.client('root', ipv4, key_path)
+
+        # -- who only lists sessions with a terminal, so every established ssh connection counts instead,
+        # -- except the daemon's own, which the box sees as coming from its local port
+        own_port = str(client.get_transport().sock.getsockname()[1])
+        cmd = f"ss -Htn state established '( sport = :{ConnectionPool.port} )'; cat /proc/loadavg"
+
+        _, stdout, _ = client.exec_command(cmd, timeout=10)
+        *connections, loadavg = stdout.read().decode('utf8').strip().split('\n')
+
+        sessions = [line for line in connections if line.split()[-1].rsplit(':', 1)[1] != own_port]
+
+        return not sessions and float(loadavg.split()[0]) < self.idle_load
+
+    def suspend_idle(self) -> None:
+        """Suspend every box that has been idle for longer than the idle timeout. Boxes are found
+        through the ssh configs written by `box up`"""
+        from .ssh_config import SSHConfig
+        from .connections import ConnectionPool
+        from .hardware_backends import DevBoxMultipass
+
+        for config_path in SSHConfig.folder().glob('*.config'):
+            name = config_path.stem
+
+            try:
+                idle = self.idle(name)
+            except Exception as err:
+                logging.warning(f'📦 could not check whether {name} is idle: {err}')
+                idle = None
+
+            if not idle:
+                self.idle_since.pop(name, None)
+                continue
+
+            since = self.idle_since.setdefault(name, time.monotonic())
+
+            if time.monotonic() - since < self.idle_timeout:
+                continue
+
+            logging.info(f'📦 suspending {name}, idle for {round((time.monotonic() - since) / 60)} minutes')
+            vm = DevBoxMultipass(name)
+
+            # -- not while a client is configuring or logging into a box
+            with self.lock:
+                try:
+                    ConnectionPool.forget(vm.ip())
+                    vm.suspend()
+                except (Exception, SystemExit) as err:
+                    logging.warning(f'📦 could not suspend {name}: {err}')
+
+            self.idle_since.pop(name, None)
+
+    def watch_idle(self) -> None:
+        while not self.stopped.wait(self.idle_interval):
+            self.suspend_idle()
+
+    def serve(self, request: dict, wfile) -> int:
+        command = request['command']
+        args = request['args']
+
+        if command == 'ip':
+            ReplyStream(wfile, 'stdout').write(f'{self.vm().ip()}\n')
+            return 0
+
+        # -- the remaining commands resolve paths in box.yaml against the client's working directory
+        with self.lock:
+            self.forget_run()
+            self.sync()
+            os.chdir(request['cwd'])
+            fpath = Path(args.get('config') or 'box.yaml').resolve()
+
+            if not fpath.exists():
+                ReplyStream(wfile, 'stderr').write(f'📦 file "{fpath}" does not exist.\n')
+                return 1
+
+            cfg = self.config(fpath)
+
+            if command == 'in':
+                argv = self.vm().login_command(cfg, args.get('user'), args.get('cmd'))
+
+                if not argv:
+                    ReplyStream(wfile, 'stderr').write('📦 cannot access instance, no IP found.\n')
+                    return 1
+
+                wfile.write(json.dumps({'argv': argv}).encode('utf8') + b'\n')
+                return 0
+
+            if command == 'configure':
+                if args.get('playbook'):
+                    cfg.playbooks = [args['playbook']]
+
+                return self.configure(cfg, args, wfile)
+
+        ReplyStream(wfile, 'stderr').write(f'📦 unsupported command {command}\n')
+        return 1
+
+    def configure(self, cfg, args: dict, wfile) -> int:
+        """Configure the instance, streaming its progress and playbook output to the client"""
+        stdout = ReplyStream(wfile, 'stdout')
+        stderr = ReplyStream(wfile, 'stderr')
+
+        handler = logging.StreamHandler(stderr)
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        logging.getLogger().addHandler(handler)
+
+        try:
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                self.vm().configure(cfg, {'force': args.get('force'), 'all': args.get('all')})
+        finally:
+            logging.getLogger().removeHandler(handler)
+
+        return 0
+
+    def run(self) -> None:
+        """Serve requests until interrupted"""
+        if not hasattr(socket, 'AF_UNIX'):
+            logging.error('📦 box daemon requires Unix domain sockets, which this platform does not support')
+            exit(1)
+
+        conn = DaemonClient.connect()
+
+        if conn:
+            conn.close()
+            logging.error(f'📦 a box daemon is already listening on {socket_path()}')
+            exit(1)
+
+        if os.path.exists(socket_path()):
+            os.remove(socket_path())
+
+        # -- only the current user may connect
+        previous = os.umask(0o177)
+
+        try:
+            server = socketserver.ThreadingUnixStreamServer(str(socket_path()), DaemonHandler)
+        finally:
+            os.umask(previous)
+
+        server.daemon = self
+        server.daemon_threads = True
+
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+        if self.idle_timeout:
+            threading.Thread(target=self.watch_idle, daemon=True).start()
+            logging.info(f'📦 suspending boxes idle for {round(self.idle_timeout / 60)} minutes')
+        logging.info(f'📦 box daemon listening on {socket_path()}')
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped.set()
+            server.server_close()
+            os.remove(socket_path())
@@ -0,0 +1,119 @@
+
+import re
+import time
+import asyncio
+from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import logging
+from .multipass import Multipass
+from .hardware_backends import DevBoxMultipass
+from .pool import WarmPool
+
+
+class Fleet:
+    """Provision and manage a group of identically configured boxes, named <prefix>-1 to <prefix>-N"""
+    prefix: str
+    concurrency: int
+
+    def __init__(self, prefix: str, concurrency: int = 4) -> None:
+        self.prefix = prefix
+        self.concurrency = concurrency
+
+    def names(self, count: int) -> list[str]:
+        return [f'{self.prefix}-{idx}' for idx in range(1, count + 1)]
+
+    def members(self) -> list[str]:
+        """List existing boxes belonging to this fleet, including those backed by claimed warm pool spares"""
+        pattern = re.compile(f'^{re.escape(self.prefix)}-([0-9]+)$')
+        names = set(Multipass.snapshot()) | set(WarmPool.aliases())
+        members = [name for name in names if pattern.match(name)]
+
+        return sorted(members, key=lambda name: int(pattern.match(name).group(1)))
+
+    async def provision(self, name: str, opts: dict, semaphore: asyncio.Semaphore) -> dict:
+        """Bring up a single fleet member, capturing its outcome rather than exiting"""
+        async with semaphore:
+            start_time = time.monotonic()
+            vm = DevBoxMultipass(name)
+
+            try:
+                await vm.up_async(opts)
+            except (Exception, SystemExit) as err:
+                return {
+                    'name': name,
+                    'status': 'failed',
+                    'ip': None,
+                    'seconds': round(time.monotonic() - start_time),
+                    'error': str(err) or type(err).__name__
+                }
+
+            return {
+                'name': name,
+                'status': 'ok',
+                'ip': vm.ip(),
+                'seconds': round(time.monotonic() - start_time),
+                'error': None
+            }
+
+    async def up_async(self, count: int, opts: dict) -> list[dict]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        return await asyncio.gather(*[
+            self.provision(name, opts, semaphore) for name in self.names(count)])
+
+    def up(self, count: int, opts: dict) -> None:
+        """Launch, wait for and configure count instances concurrently"""
+        start_time = time.monotonic()
+        statuses = asyncio.run(self.up_async(count, opts))
+
+        self.report(statuses)
+
+        seconds_elapsed = round(time.monotonic() - start_time)
+        failed = [status for status in statuses if status['status'] != 'ok']
+
+        logging.info(
+            f'📦 fleet {self.prefix}: {count - len(failed)}/{count} instances up (+{seconds_elapsed}s)')
+
+        if failed:
+            exit(1)
+
+    def report(self, statuses: list[dict]) -> None:
+        for status in statuses:
+            line = f"📦 {status['name']:<20} {status['status']:<7} {status['ip'] or '-':<16} +{status['seconds']}s"
+
+            if status['error']:
+                line += f" {status['error']}"
+
+            logging.info(line)
+
+    def each(self, action: Callable[[str], Optional[str]]) -> dict:
+        """Apply an action to every fleet member concurrently, returning results by name"""
+        members = self.members()
+
+        if not members:
+            logging.error(f'📦 no instances found with prefix {self.prefix}')
+            exit(1)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = executor.map(action, members)
+
+        return dict(zip(members, results))
+
+    def stop(self) -> None:
+        self.each(lambda name: DevBoxMultipass(name).stop())
+
+    def start(self, opts: dict) -> None:
+        self.each(lambda name: DevBoxMultipass(name).start(opts))
+
+    def suspend(self) -> None:
+        self.each(lambda name: DevBoxMultipass(name).suspend())
+
+    def resume(self) -> None:
+        self.each(lambda name: DevBoxMultipass(name).resume())
+
+    def delete(self) -> None:
+        self.each(lambda name: DevBoxMultipass(name).delete())
+
+    def ips(self) -> dict:
+        return self.each(lambda name: DevBoxMultipass(name).ip())
@@ -0,0 +1,124 @@
+
+import json
+import asyncio
+import hashlib
+import time
+
+from .box_config import BoxConfig
+from .multipass import Multipass
+from .software_backends import VMConfigurators
+from .utils import logging, cache_dir
+
+
+class GoldenImage:
+    """A bootstrapped and configured instance, kept stopped, that new boxes are cloned from
+    rather than bootstrapped from scratch. It is keyed by a hash of the rendered cloud-init and
+    playbooks, so it is rebuilt whenever either changes, and of the box.yaml it belongs to."""
+    PREFIX = 'box-golden-'
+
+    # -- one build per golden image, even when a fleet asks for it concurrently
+    locks: dict = {}
+
+    cfg: BoxConfig
+    cloud_init: str
+    owner: str
+
+    def __init__(self, cfg: BoxConfig, cloud_init: str, owner: str) -> None:
+        self.cfg = cfg
+        self.cloud_init = cloud_init
+        self.owner = owner
+
+    def key(self) -> str:
+        digest = hashlib.sha256(self.cloud_init.encode('utf8'))
+
+        # -- the image holds the project's copied files, which may be secrets, so projects never share one
+        digest.update(self.owner.encode('utf8'))
+
+        for playbook in self.cfg.playbooks:
+            with open(playbook, 'rb') as conn:
+                digest.update(conn.read())
+
+        return digest.hexdigest()[:12]
+
+    @property
+    def name(self) -> str:
+        return f'{GoldenImage.PREFIX}{self.key()}'
+
+    @staticmethod
+    def registry_path():
+        return cache_dir() / 'golden.json'
+
+    def replace_previous(self) -> None:
+        """Delete the golden image previously built for this box.yaml, as it is now stale. Images are
+        tracked per box.yaml rather than per key folder, as projects often share a key folder"""
+        owner = self.owner
+
+        try:
+            with open(GoldenImage.registry_path()) as conn:
+                registry = json.load(conn)
+        except (FileNotFoundError, ValueError):
+            registry = {}
+
+        previous = registry.get(owner)
+
+        if previous and previous != self.name and previous in Multipass.snapshot():
+            logging.info(f'📦 deleting stale golden image {previous}')
+            Multipass.delete(previous)
+
+        registry[owner] = self.name
+
+        with open(GoldenImage.registry_path(), 'w') as conn:
+            json.dump(registry, conn, indent=2)
+
+    async def build(self, opts: dict) -> None:
+        """Launch, bootstrap and configure the golden instance, then stop it so it can be cloned"""
+        loop = asyncio.get_running_loop()
+        start_time = time.monotonic()
+
+        logging.info(f'📦 building golden image {self.name}...')
+
+        await Multipass.launch_async({
+            'name': self.name,
+            'config': self.cloud_init,
+            'ram': self.cfg.memory,
+            'disk': self.cfg.disk,
+            'image': 'ubuntu'
+        })
+
+        ipv4 = await loop.run_in_executor(None, Multipass.ip, self.name)
+
+        if not ipv4:
+            logging.error(f'📦 ipv4 not present for golden image {self.name}')
+            exit(1)
+
+        if self.cfg.mounts:
+            await loop.run_in_executor(None, Multipass.sync_mounts, self.name, self.cfg.mounts)
+
+        configurator = VMConfigurators.select(self.cfg)(self.name, ipv4)
+        configurator.configure(self.cfg, opts)
+
+        await loop.run_in_executor(None, configurator.run)
+        await loop.run_in_executor(None, Multipass.stop, self.name)
+        await loop.run_in_executor(None, self.replace_previous)
+
+        seconds_elapsed = round(time.monotonic() - start_time)
+        logging.info(f'📦 golden image {self.name} built (+{seconds_elapsed}s)')
+
+    async def clone(self, name: str, opts: dict) -> None:
+        """Create the instance name from the golden image, building the image first if required"""
+        lock = GoldenImage.locks.setdefault(self.name, asyncio.Lock())
+
+        async with lock:
+            golden = Multipass.snapshot().get(self.name)
+
+            if not golden:
+                await self.build(opts)
+            elif golden['state'] != 'Stopped':
+                await asyncio.get_running_loop().run_in_executor(None, Multipass.stop, self.name)
+
+        logging.info(f'📦 cloning {name} from golden image {self.name}')
+
+        await Multipass.clone_async(self.name, name, {
+            'ram': self.cfg.memory,
+            'disk': self.cfg.disk
+        })
@@ -1,18 +1,18 @@
 
 import os
 import time
-import yaml
-from yaml.parser import ParserError
+import subprocess
 
 from .utils import logging
 from typing import Optional
-from .cloud_init import BootstrappingCloudInit
-from .ssh import SSH
 from .multipass import Multipass
+from .tracing import Tracer
 from abc import ABC, abstractmethod
-from .software_backends import VMConfigurators
 from .box_config import BoxConfig
 
+# -- yaml, asyncio, and the SSH, copy and configuration stack (which loads paramiko) are imported
+# -- by the methods that use them, so light commands like `box ip` and `box stop` start quickly
+
 
 class DevBox(ABC):
     """An abstract class for each hardware backend"""
@@ -21,7 +21,7 @@ class DevBox(ABC):
         pass
 
     @abstractmethod
-    def up(self) -> None:
+    def up(self, opts: dict) -> None:
         pass
 
     @abstractmethod
@@ -37,7 +37,15 @@ class DevBox(ABC):
         pass
 
     @abstractmethod
-    def configure(self, cfg: BoxConfig) -> None:
+    def suspend(self) -> None:
+        pass
+
+    @abstractmethod
+    def resume(self) -> None:
+        pass
+
+    @abstractmethod
+    def configure(self, cfg: BoxConfig, opts: Optional[dict] = None) -> None:
         pass
 
     @abstractmethod
@@ -49,15 +57,29 @@ class DevBoxMultipass(DevBox):
     """Set up a devbox using multipass as a VM middle-layer, and
     ansible as a configurator"""
     name: str
+    preseeded: list[str]
 
     def __init__(self, name: str) -> None:
         self.name = name
+        self.preseeded = []
+
+    @property
+    def instance(self) -> str:
+        """The multipass instance backing this devbox; a spare claimed from the warm pool has its own name"""
+        from .pool import WarmPool
+        return WarmPool.resolve(self.name)
 
-    def configure(self, cfg: BoxConfig) -> None:
+    def configure(self, cfg: BoxConfig, opts: Optional[dict] = None) -> None:
         """configure the multipass VM"""
         if not cfg.playbooks:
             return
 
+        from .software_backends import VMConfigurators
+
+        if cfg.artifact_cache:
+            from .artifacts import ArtifactCache
+            ArtifactCache.serve()
+
         # -- configure via ansible, otherwise just exit.
 
         logging.info(f'📦 configuring {self.name}...')
@@ -68,23 +90,26 @@ class DevBoxMultipass(DevBox):
             logging.error(f'📦 ipv4 not present')
             exit(1)
 
-        configurator = VMConfigurators.ansible(self.name, ipv4)
-        configurator.configure(cfg)
-        configurator.run()
+        with Tracer.span('configure', box=self.name):
+            configurator = VMConfigurators.select(cfg)(self.name, ipv4)
+            configurator.configure(cfg, opts)
+            configurator.run()
 
     def ip(self) -> Optional[str]:
         """Fetch an IP address for a multipass vm"""
-        info = Multipass.info(self.name)
-        return info['ipv4'][0] if info else None
+        return Multipass.ip(self.instance)
 
     def load_config(self, fpath: Optional[str]) -> BoxConfig:
         """Load configuration from a file"""
+        import yaml
+        from yaml.parser import ParserError
+
         default_cfg = os.path.join(os.getcwd(), 'box.yaml')
 
         if fpath and not os.path.exists(fpath):
             logging.error(f'file "{fpath}" does not exist.')
             exit(1)
-        elif default_cfg and not os.path.exists(default_cfg):
+        elif not fpath and not os.path.exists(default_cfg):
             logging.error(f'file "{default_cfg}" does not exist.')
             exit(1)
 
@@ -94,41 +119,156 @@ class DevBoxMultipass(DevBox):
             try:
                 opts = yaml.load(conn.read(), Loader=yaml.SafeLoader)
 
-                return BoxConfig(
+                cfg = BoxConfig(
                     user=opts['user'],
                     memory=opts['memory'],
                     disk=opts['disk'],
                     playbooks=opts['playbooks'],
                     copy=opts['copy'],
-                    key_folder=opts['key_folder']
+                    key_folder=opts['key_folder'],
+                    transfer_workers=opts.get('transfer_workers', 4),
+                    vars=opts.get('vars'),
+                    single_session=opts.get('single_session', False),
+                    key_type=opts.get('key_type'),
+                    preseed_threshold=opts.get('preseed_threshold', 0),
+                    artifact_cache=opts.get('artifact_cache', False),
+                    configurator=opts.get('configurator', 'bootstrap')
                 )
             except:
                 raise ParserError(f'failed to parse {tgt} as yaml')
 
-    def up(self) -> None:
-        """Initialise and configure a multipass VM"""
-        cfg = self.load_config(None)
+        if cfg.key_type is None:
+            cfg.key_type = self.recorded_key_type(cfg)
+
+        return cfg
+
+    def recorded_key_type(self, cfg: BoxConfig) -> Optional[str]:
+        """The type of key box last logged into this box with, if it came from the configured key folder,
+        so an existing box keeps its key whichever other keypairs the folder gains"""
+        from .keys import KeyManager
+        from .ssh_config import SSHConfig
+
+        identity = SSHConfig(self.name).identity()
+
+        if not identity or not identity.exists() or identity.parent.resolve() != cfg.key_folder.resolve():
+            return None
+
+        return KeyManager.key_type(identity)
+
+    def prepare(self, cfg: BoxConfig) -> None:
+        """Host-side work that does not need the instance, so can run while it boots:
+        validate playbooks, and fingerprint every copy entry ahead of the upload"""
+        import yaml
+        from yaml.parser import ParserError
+        from .manifest import Manifest
+
+        with Tracer.span('prepare', box=self.name):
+            for playbook in cfg.playbooks:
+                with open(playbook) as conn:
+                    try:
+                        yaml.load(conn.read(), Loader=yaml.SafeLoader)
+                    except yaml.YAMLError:
+                        raise ParserError(f'failed to parse playbook {playbook} as yaml')
 
+            manifest = Manifest(self.name)
+
+            for entry in cfg.copy:
+                if entry['mode'] == 'copy':
+                    manifest.fingerprint(entry['src'])
+
+            for playbook in cfg.playbooks:
+                manifest.fingerprint(playbook)
+
+            manifest.save_host()
+
+    def cloud_init(self, cfg: BoxConfig, preseed: Optional[list[dict]] = None) -> str:
+        """Render the bootstrapping cloud-init, serving the artifact cache to the instance if enabled"""
+        from .cloud_init import BootstrappingCloudInit
+
+        artifact_port = None
+
+        if cfg.artifact_cache:
+            from .artifacts import ArtifactCache
+            ArtifactCache.serve()
+            artifact_port = ArtifactCache.port
+
+        return BootstrappingCloudInit(cfg.user, cfg.key_folder, cfg.key_type, preseed, artifact_port,
+                                      install_ansible=cfg.configurator != 'push').to_yaml()
+
+    def claim(self, cfg: BoxConfig) -> bool:
+        """Claim and start a spare bootstrapped with this configuration from the warm pool, if there is one"""
+        from .pool import WarmPool
+
+        if not WarmPool.spares():
+            return False
+
+        spare = WarmPool.claim(self.name, WarmPool.key(cfg, self.cloud_init(cfg)))
+
+        if not spare:
+            return False
+
+        logging.info(f'📦 claimed {spare} from the warm pool for {self.name}')
+
+        with Tracer.span('pool claim', track=self.name):
+            Multipass.start(spare)
+
+        return True
+
+    def fill_pool(self, cfg: BoxConfig, size: int) -> None:
+        """Launch spares bootstrapped with this configuration until the warm pool holds size of them"""
+        import asyncio
+        from .pool import WarmPool
+
+        asyncio.run(WarmPool.fill(cfg, self.cloud_init(cfg), size))
+
+    async def launch(self, cfg: BoxConfig, opts: dict) -> str:
+        """Launch the instance if it is not running, and wait for its IP address"""
+        import asyncio
+        from .cloud_init import BootstrappingCloudInit
+        from .golden import GoldenImage
+
+        loop = asyncio.get_running_loop()
         start_time = time.monotonic()
-        info = Multipass.info(self.name)
 
-        if not info or info['state'] != 'Running':
+        instance = self.instance
+        info = await loop.run_in_executor(None, Multipass.info, instance)
+        exists = instance in Multipass.snapshot()
+
+        if exists and not info:
+            with Tracer.span('multipass start', track=self.name):
+                await loop.run_in_executor(None, Multipass.start, instance)
+
+        # -- a spare from the warm pool was bootstrapped ahead of time, so only the copy and configure steps remain
+        elif not exists and (opts.get('golden') or not await loop.run_in_executor(None, self.claim, cfg)):
             # -- we shouldn't assume Ansible is present on the machine; let's copy any ansible
             # -- content to the VM, and have the VM configure itself! One restriction is we can only really
             # -- work within a single directory
 
-            cloud_init = BootstrappingCloudInit(
-                cfg.user, cfg.key_folder).to_yaml()
+            # -- small files are written by cloud-init during first boot, rather than uploaded after it.
+            # -- Golden images are shared, so their clones receive every file by upload instead
+            preseed = [] if opts.get('golden') or not cfg.preseed_threshold else \
+                BootstrappingCloudInit.preseedable(cfg.copy, cfg.preseed_threshold)
 
-            Multipass.launch({
-                'name': self.name,
-                'config': cloud_init,
-                'ram': cfg.memory,
-                'disk': cfg.disk,
-                'image': 'ubuntu'
-            })
+            cloud_init = await loop.run_in_executor(None, self.cloud_init, cfg, preseed)
 
-        ipv4 = self.ip()
+            if opts.get('golden'):
+                with Tracer.span('golden clone', track=self.name):
+                    owner = os.path.abspath(opts.get('config') or 'box.yaml')
+                    await GoldenImage(cfg, cloud_init, owner).clone(self.name, opts)
+            else:
+                with Tracer.span('multipass launch', track=self.name):
+                    await Multipass.launch_async({
+                        'name': self.name,
+                        'config': cloud_init,
+                        'ram': cfg.memory,
+                        'disk': cfg.disk,
+                        'image': 'ubuntu'
+                    })
+
+                self.preseeded = [str(entry['dest']) for entry in preseed]
+
+        with Tracer.span('ip wait', track=self.name):
+            ipv4 = await loop.run_in_executor(None, self.ip)
 
         if not ipv4:
             logging.error(f'📦 ipv4 not present')
@@ -137,43 +277,125 @@ class DevBoxMultipass(DevBox):
         seconds_elapsed = round(time.monotonic() - start_time)
 
         logging.info(f'📦 {self.name} hardware up at {ipv4} (+{seconds_elapsed}s)')
-        start_time = time.monotonic()
 
-        self.configure(cfg)
+        return ipv4
+
+    async def up_async(self, opts: dict) -> None:
+        """Initialise and configure a multipass VM. Host-side preparation runs concurrently
+        with the VM launch, so the critical path is only boot plus configuration"""
+        import asyncio
+
+        cfg = self.load_config(opts.get('config'))
+        loop = asyncio.get_running_loop()
+
+        prepared = loop.run_in_executor(None, self.prepare, cfg)
+
+        with Tracer.span('up', track=self.name, box=self.name):
+            with Tracer.span('launch', track=self.name):
+                ipv4 = await self.launch(cfg, opts)
+
+            await prepared
+
+            if cfg.mounts:
+                with Tracer.span('mounts', track=self.name):
+                    await loop.run_in_executor(None, Multipass.sync_mounts, self.instance, cfg.mounts)
+
+            start_time = time.monotonic()
+
+            await loop.run_in_executor(None, self.configure, cfg, {**opts, 'preseeded': self.preseeded})
+            await loop.run_in_executor(None, self.ssh_config, cfg, ipv4, True)
 
         seconds_elapsed = round(time.monotonic() - start_time)
 
         logging.info(
             f'📦 {self.name} fully configured and ready to use (+{seconds_elapsed}s)')
 
+    def up(self, opts: dict) -> None:
+        """Initialise and configure a multipass VM"""
+        import asyncio
+        asyncio.run(self.up_async(opts))
 
-    def into(self, opts: dict) -> None:
-        """SSH into the devbox"""
+    def ssh_config(self, cfg: BoxConfig, ipv4: str, refresh: bool = False):
+        """Write the devbox's ssh config and pinned host key, unless they are already current"""
+        from .ssh import SSH
+        from .ssh_config import SSHConfig
+        from .connections import ConnectionPool
 
-        cfg = self.load_config(opts.get('config'))
+        config = SSHConfig(self.name)
+
+        if refresh or not config.current(ipv4):
+            _, ssh_private_path = SSH.save_keypair(cfg.key_folder, cfg.key_type)
+
+            client = ConnectionPool.client('root', ipv4, ssh_private_path)
+            host_key = client.get_transport().get_remote_server_key()
 
-        user = opts['user'] if opts.get('user') else cfg.user
+            config.write(ipv4, ConnectionPool.port, cfg.user, ssh_private_path, host_key)
 
-        Multipass.start(self.name)
+        return config
+
+    def login_command(self, cfg: BoxConfig, user: Optional[str] = None,
+                      cmd: Optional[str] = None) -> Optional[list[str]]:
+        """The ssh command line that logs into the devbox, or runs cmd on it, starting it if required"""
+        Multipass.start(self.instance)
         ipv4 = self.ip()
 
-        if ipv4:
-            with SSH(user, ipv4, cfg) as ssh:
-                ssh.open(cfg.key_folder)
-        else:
+        if not ipv4:
+            return None
+
+        return self.ssh_config(cfg, ipv4).command(user, cmd)
+
+    def into(self, opts: dict) -> None:
+        """SSH into the devbox, or run a single command on it. Sessions share one master connection"""
+        cfg = self.load_config(opts.get('config'))
+        command = self.login_command(cfg, opts.get('user'), opts.get('cmd'))
+
+        if not command:
             logging.error(f'📦 cannot access instance, no IP found.')
+            exit(1)
+
+        status = subprocess.run(command).returncode
+
+        if status:
+            exit(status)
 
     def stop(self):
         """Stop a multipass devbox"""
-        Multipass.stop(self.name)
+        from .ssh_config import SSHConfig
+
+        SSHConfig(self.name).close()
+        Multipass.stop(self.instance)
+
+    def start(self, opts: Optional[dict] = None):
+        """Start a multipass devbox, and mount any of its mount entries that are missing"""
+        Multipass.start(self.instance)
+
+        fpath = (opts or {}).get('config')
+
+        if fpath or os.path.exists(os.path.join(os.getcwd(), 'box.yaml')):
+            cfg = self.load_config(fpath)
 
-    def start(self):
-        """Start a multipass devbox"""
-        Multipass.start(self.name)
+            if cfg.mounts:
+                Multipass.sync_mounts(self.instance, cfg.mounts)
+
+    def suspend(self):
+        """Suspend a multipass devbox, keeping its memory state"""
+        from .ssh_config import SSHConfig
+
+        SSHConfig(self.name).close()
+        Multipass.suspend(self.instance)
+
+    def resume(self):
+        """Resume a suspended multipass devbox"""
+        Multipass.start(self.instance)
 
     def delete(self):
         """Delete a multipass devbox"""
-        Multipass.delete(self.name)
+        from .ssh_config import SSHConfig
+        from .pool import WarmPool
+
+        SSHConfig(self.name).remove()
+        Multipass.delete(self.instance)
+        WarmPool.forget(self.name)
 
 
 class DevBoxProvisioner():
@@ -0,0 +1,193 @@
+
+import time
+import sqlite3
+import statistics
+from pathlib import Path
+from typing import Optional
+
+from .utils import cache_dir
+
+# -- the spans stored as phases; per-task Ansible spans and fine-grained spans are left out
+PHASES = ['up', 'launch', 'multipass launch', 'golden clone', 'ip wait', 'prepare',
+          'configure', 'copy entries', 'ssh connect']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    command TEXT NOT NULL,
+    box TEXT NOT NULL,
+    status TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    bytes INTEGER NOT NULL,
+    boxes INTEGER NOT NULL DEFAULT 1
+);
+
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (run_id, phase)
+);
+'''
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class History:
+    """A local SQLite store of each run's phase timings, bytes transferred and playbook durations,
+    used to report percentiles and flag phases that regressed against recent runs"""
+    fpath: Path
+
+    # -- a phase regressed if its latest duration exceeds the median of the previous
+    # -- `window` successful runs by `threshold` times, and by at least `min_delta` seconds
+    window: int = 10
+    threshold: float = 1.25
+    min_delta: float = 1.0
+
+    def __init__(self, fpath: Optional[Path] = None) -> None:
+        self.fpath = fpath or cache_dir() / 'history.sqlite'
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.fpath)
+        conn.executescript(SCHEMA)
+
+        # -- histories written before fleet runs were told apart have no box count
+        if 'boxes' not in [row[1] for row in conn.execute('PRAGMA table_info(runs)')]:
+            conn.execute('ALTER TABLE runs ADD COLUMN boxes INTEGER NOT NULL DEFAULT 1')
+
+        return conn
+
+    @staticmethod
+    def phases(spans: list[dict]) -> tuple[dict, int]:
+        """Total each phase's duration in seconds, and the bytes copied, from recorded trace spans"""
+        totals = {}
+        copied = 0
+
+        for span in spans:
+            name = span['name']
+            args = span.get('args', {})
+
+            if name in ('copy', 'copy tree'):
+                copied += args.get('bytes', 0)
+
+            if name == 'playbook':
+                name = f"playbook {Path(args['playbook']).name}"
+            elif name not in PHASES:
+                continue
+
+            totals[name] = totals.get(name, 0) + span['dur'] / 1e6
+
+        return totals, copied
+
+    @staticmethod
+    def boxes(spans: list[dict]) -> int:
+        """How many boxes a run provisioned or configured; a fleet's phases are totalled over all of them"""
+        names = {span['args']['box'] for span in spans if 'box' in span.get('args', {})}
+
+        return max(1, len(names))
+
+    def record(self, command: str, box: str, status: str, seconds: float, spans: list[dict]) -> None:
+        """Store a run, with the phases found in its trace spans"""
+        totals, copied = History.phases(spans)
+
+        with self.connect() as conn:
+            cursor = conn.execute(
+                'INSERT INTO runs (started, command, box, status, seconds, bytes, boxes) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (time.time() - seconds, command, box, status, seconds, copied, History.boxes(spans)))
+
+            conn.executemany(
+                'INSERT INTO phases (run_id, phase, seconds) VALUES (?, ?, ?)',
+                [(cursor.lastrowid, phase, total) for phase, total in totals.items()])
+
+        conn.close()
+
+    def runs(self, command: str, limit: int) -> list[dict]:
+        """The last `limit` successful runs of a command, oldest first. Each maps the phases it ran to
+        their durations, with the whole run as 'total', bytes copied as 'bytes' and the box count as 'boxes'"""
+        runs = []
+
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT id, seconds, bytes, boxes FROM runs WHERE command = ? AND status = 'ok' ORDER BY id DESC LIMIT ?",
+                (command, limit)).fetchall()[::-1]
+
+            for run_id, seconds, copied, boxes in rows:
+                run = {'total': seconds, 'bytes': copied, 'boxes': boxes}
+                run.update(conn.execute('SELECT phase, seconds FROM phases WHERE run_id = ?', (run_id,)).fetchall())
+                runs.append(run)
+
+        conn.close()
+
+        return runs
+
+    @staticmethod
+    def kind(command: str, run: dict) -> str:
+        """Group runs so each is compared with runs like it; an `up` that launches an instance takes far
+        longer than one against an instance that already exists, and a fleet's phases add up over its boxes"""
+        fleet = f', a fleet of {run["boxes"]}' if run['boxes'] > 1 else ''
+
+        if command != 'up':
+            return f'{command}{fleet}'
+        elif 'multipass launch' in run:
+            return f'up{fleet}, launching instances' if fleet else 'up, launching an instance'
+        elif 'golden clone' in run:
+            return f'up{fleet}, cloning a golden image'
+
+        return f'up{fleet}, on existing instances' if fleet else 'up, on an existing instance'
+
+    def regressed(self, latest: float, previous: list[float]) -> Optional[float]:
+        """Return the baseline the latest value regressed against, or None"""
+        previous = previous[-self.window:]
+
+        if not previous:
+            return None
+
+        baseline = statistics.median(previous)
+
+        if latest > baseline * self.threshold and latest - baseline >= self.min_delta:
+            return baseline
+
+        return None
+
+    def report(self, limit: int = 50) -> str:
+        """Summarise phase percentiles for each kind of run, flagging phases that regressed in the latest run"""
+        lines = []
+
+        for command in ['up', 'configure']:
+            groups = {}
+
+            for run in self.runs(command, limit):
+                groups.setdefault(History.kind(command, run), []).append(run)
+
+            for kind, runs in groups.items():
+                latest = runs[-1]
+                mib = statistics.median(run['bytes'] for run in runs) / 1024 ** 2
+
+                lines.append(f'📦 box {kind}: {len(runs)} successful runs, median {mib:.1f} MiB copied')
+                lines.append(f"  {'phase':<32} {'p50':>8} {'p90':>8} {'p99':>8} {'latest':>8}")
+
+                # -- only phases the latest run had; each is compared with earlier runs that had it too
+                for phase, seconds in latest.items():
+                    if phase in ('bytes', 'boxes'):
+                        continue
+
+                    values = [run[phase] for run in runs if phase in run]
+
+                    line = f'  {phase:<32}' + ''.join(
+                        f' {percentile(values, pct):>7.1f}s' for pct in [50, 90, 99]) + f' {seconds:>7.1f}s'
+
+                    baseline = self.regressed(seconds, values[:-1])
+
+                    if baseline is not None:
+                        line += f'  regressed, baseline {baseline:.1f}s'
+
+                    lines.append(line)
+
+        return '\n'.join(lines) if lines else '📦 no runs recorded yet'
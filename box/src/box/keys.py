@@ -0,0 +1,125 @@
+
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from .tracing import Tracer
+
+# -- without a key_type, an existing legacy RSA keypair is reused first, so a project adding an Ed25519
+# -- keypair to a shared key folder does not move the other projects' boxes off their authorised key
+KEY_TYPES = ['rsa', 'ed25519']
+
+KEY_NAMES = {
+    'ed25519': 'mystery_box_ed25519',
+    'rsa': 'mystery_box'
+}
+
+
+class KeyManager:
+    """Generate the box keypair once, and cache it and its loaded private key for the rest of the process.
+    Ed25519 keys are generated in milliseconds, where 4096-bit RSA keys take seconds."""
+    pairs: dict = {}
+    pkeys: dict = {}
+    lock = threading.RLock()
+
+    @staticmethod
+    def paths(folder: Path, key_type: str) -> tuple[Path, Path]:
+        name = KEY_NAMES[key_type]
+        return folder / f'{name}.pub', folder / name
+
+    @staticmethod
+    def key_type(private_key_path: Path) -> Optional[str]:
+        """The type of a keypair box generated, from its private key's name"""
+        return next((key_type for key_type, name in KEY_NAMES.items() if name == private_key_path.name), None)
+
+    @staticmethod
+    def exists(folder: Path, key_type: str) -> bool:
+        public_key_path, private_key_path = KeyManager.paths(folder, key_type)
+        return os.path.isfile(public_key_path) and os.path.isfile(private_key_path)
+
+    @classmethod
+    def keypair(cls, folder: Path, key_type: Optional[str] = None) -> tuple[Path, Path]:
+        """Return (public, private) key paths, generating the keypair if required. Without a key_type,
+        an existing keypair is reused, preferring RSA, and new keypairs are Ed25519"""
+        with cls.lock:
+            cached = cls.pairs.get((str(folder), key_type))
+
+            if cached:
+                return cached
+
+            if not os.path.isdir(folder):
+                raise FileNotFoundError(f'{folder} does not exist')
+
+            folder.chmod(0o700)
+
+            if key_type is None:
+                existing = [candidate for candidate in KEY_TYPES if KeyManager.exists(folder, candidate)]
+                key_type = existing[0] if existing else 'ed25519'
+
+            public_key_path, private_key_path = KeyManager.paths(folder, key_type)
+
+            if not KeyManager.exists(folder, key_type):
+                # -- if one, but not both exists, wipe the keys
+                for fpath in [public_key_path, private_key_path]:
+                    if os.path.isfile(fpath):
+                        os.remove(fpath)
+
+                with Tracer.span('key generate', key_type=key_type):
+                    KeyManager.generate(key_type, public_key_path, private_key_path)
+
+            cls.pairs[(str(folder), key_type)] = (public_key_path, private_key_path)
+            cls.pairs[(str(folder), None)] = (public_key_path, private_key_path)
+
+            return public_key_path, private_key_path
+
+    @staticmethod
+    def generate(key_type: str, public_key_path: Path, private_key_path: Path) -> None:
+        """Save a newly generated keypair"""
+
+        if key_type == 'ed25519':
+            priv_key = ed25519.Ed25519PrivateKey.generate()
+
+            private_bytes = priv_key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.OpenSSH,
+                serialization.NoEncryption())
+
+            public_bytes = priv_key.public_key().public_bytes(
+                serialization.Encoding.OpenSSH,
+                serialization.PublicFormat.OpenSSH)
+
+            with open(os.open(private_key_path, os.O_WRONLY | os.O_CREAT, 0o600), 'wb') as conn:
+                conn.write(private_bytes)
+
+            with open(public_key_path, 'wb') as conn:
+                conn.write(public_bytes)
+
+            return
+
+        priv_key = paramiko.RSAKey.generate(bits=4096)
+        priv_key.write_private_key_file(str(private_key_path))
+
+        with open(public_key_path, 'w') as conn:
+            conn.write('{0} {1}'.format(
+                priv_key.get_name(), priv_key.get_base64()))
+
+    @classmethod
+    def private_key(cls, private_key_path: Path) -> paramiko.PKey:
+        """Load a private key, parsing each key file only once per process"""
+        with cls.lock:
+            pkey = cls.pkeys.get(str(private_key_path))
+
+            if pkey is None:
+                with Tracer.span('key parse', path=str(private_key_path)):
+                    if Path(private_key_path).name == KEY_NAMES['ed25519']:
+                        pkey = paramiko.Ed25519Key.from_private_key_file(str(private_key_path))
+                    else:
+                        pkey = paramiko.RSAKey.from_private_key_file(str(private_key_path))
+
+                cls.pkeys[str(private_key_path)] = pkey
+
+            return pkey
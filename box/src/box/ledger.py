@@ -0,0 +1,55 @@
+
+import os
+import json
+import hashlib
+from pathlib import Path
+
+from .box_config import BoxConfig
+from .manifest import Manifest, REMOTE_STATE
+
+
+class Ledger:
+    """Records, on the instance, a fingerprint of each playbook it applied successfully. A
+    fingerprint covers the playbook, its copied inputs and its variables, so a playbook whose
+    fingerprint is unchanged does not need to be applied again."""
+    applied: dict
+
+    def __init__(self) -> None:
+        self.applied = {}
+
+    def load(self, scp, folder: Path) -> None:
+        content = scp.read_text(folder, REMOTE_STATE / 'ledger.json')
+
+        try:
+            self.applied = json.loads(content) if content else {}
+        except ValueError:
+            self.applied = {}
+
+    def save(self, scp, folder: Path) -> None:
+        scp.write_text(folder, REMOTE_STATE / 'ledger.json',
+                       json.dumps(self.applied, indent=2, sort_keys=True))
+
+    @staticmethod
+    def fingerprint(playbook: Path, cfg: BoxConfig, manifest: Manifest) -> str:
+        """Fingerprint a playbook together with every copied input and the playbook variables"""
+        digest = hashlib.sha256()
+        digest.update(manifest.fingerprint(playbook)['sha256'].encode('utf8'))
+
+        for entry in sorted(cfg.copy, key=lambda entry: str(entry['dest'])):
+            digest.update(str(entry['dest']).encode('utf8'))
+
+            # -- mounted trees are too large to hash on every run, so only where they are mounted from is covered
+            if entry['mode'] == 'mount':
+                digest.update(f"mount {os.path.abspath(entry['src'])}".encode('utf8'))
+            else:
+                digest.update(manifest.fingerprint(entry['src'])['sha256'].encode('utf8'))
+
+        digest.update(json.dumps(cfg.vars, sort_keys=True).encode('utf8'))
+
+        return digest.hexdigest()
+
+    def unchanged(self, name: str, fingerprint: str) -> bool:
+        return self.applied.get(name) == fingerprint
+
+    def record(self, name: str, fingerprint: str) -> None:
+        self.applied[name] = fingerprint
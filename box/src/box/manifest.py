@@ -0,0 +1,139 @@
+
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Optional
+
+from .utils import cache_dir
+
+# -- remote state lives in the login user's home directory on the instance
+REMOTE_STATE = Path('.mystery-box')
+
+
+class Manifest:
+    """Track the hash, size and mtime of each copied file on the host and the instance,
+    so unchanged entries are not uploaded again."""
+    name: str
+    host: dict
+    seen: dict
+    remote: dict
+
+    # -- fingerprints computed by this process, shared between manifests
+    memo: dict = {}
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.host = self.load_host()
+        self.seen = {}
+        self.remote = {}
+
+    def host_path(self) -> Path:
+        folder = cache_dir() / 'manifests'
+        folder.mkdir(exist_ok=True)
+
+        return folder / f'{self.name}.json'
+
+    def load_host(self) -> dict:
+        """Load the host manifest, which caches hashes of previously seen files"""
+        try:
+            with open(self.host_path()) as conn:
+                return json.load(conn)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_host(self) -> None:
+        """Persist the host manifest; only files seen this run are kept"""
+        with open(self.host_path(), 'w') as conn:
+            json.dump(self.seen, conn, indent=2, sort_keys=True)
+
+    @staticmethod
+    def hash_file(fpath: str) -> str:
+        digest = hashlib.sha256()
+
+        with open(fpath, 'rb') as conn:
+            for chunk in iter(lambda: conn.read(1024 * 1024), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def file_fingerprint(self, fpath: str) -> dict:
+        """Fingerprint a file, rehashing only if its size or mtime changed since the last run"""
+        stat = os.stat(fpath)
+        key = (fpath, stat.st_size, stat.st_mtime_ns)
+        cached = self.seen.get(fpath) or self.host.get(fpath)
+
+        if key in Manifest.memo:
+            record = Manifest.memo[key]
+        elif cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime_ns:
+            record = cached
+        else:
+            record = {
+                'sha256': self.hash_file(fpath),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns
+            }
+
+        Manifest.memo[key] = record
+        self.seen[fpath] = record
+
+        return record
+
+    @classmethod
+    def reset(cls) -> None:
+        cls.memo = {}
+
+    def fingerprint(self, src: Path) -> dict:
+        """Fingerprint a file or directory copy-source"""
+        if not os.path.isdir(src):
+            return self.file_fingerprint(str(src))
+
+        digest = hashlib.sha256()
+        size = 0
+        mtime = 0
+
+        for root, dirs, files in os.walk(src):
+            dirs.sort()
+
+            for fname in sorted(files):
+                fpath = os.path.join(root, fname)
+                record = self.file_fingerprint(fpath)
+
+                digest.update(os.path.relpath(fpath, src).encode('utf8'))
+                digest.update(record['sha256'].encode('utf8'))
+
+                size += record['size']
+                mtime = max(mtime, record['mtime'])
+
+        return {
+            'sha256': digest.hexdigest(),
+            'size': size,
+            'mtime': mtime
+        }
+
+    def load_remote(self, scp, folder: Path) -> None:
+        """Load the manifest of previously uploaded entries from the instance"""
+        content = scp.read_text(folder, REMOTE_STATE / 'manifest.json')
+
+        try:
+            self.remote = json.loads(content) if content else {}
+        except ValueError:
+            self.remote = {}
+
+    def save_remote(self, scp, folder: Path) -> None:
+        scp.write_text(folder, REMOTE_STATE / 'manifest.json',
+                       json.dumps(self.remote, indent=2, sort_keys=True))
+
+    def changed(self, src: Path, dest: Path) -> Optional[dict]:
+        """Return the source fingerprint if dest on the instance differs from it, otherwise None"""
+        record = self.fingerprint(src)
+        uploaded = self.remote.get(str(dest))
+
+        if uploaded and uploaded['sha256'] == record['sha256'] and uploaded['size'] == record['size']:
+            return None
+
+        return record
+
+    def record(self, dest: Path, fingerprint: dict) -> None:
+        """Mark dest as uploaded with the provided fingerprint"""
+        self.remote[str(dest)] = fingerprint
@@ -1,80 +1,224 @@
 
+import os
 import json
+import time
+import tempfile
 import subprocess
-from typing import Optional
-from .utils import logging
+from pathlib import Path
+from typing import Iterable, Optional
+from .utils import logging, cache_dir
+from .tracing import Tracer
 
 
 class Multipass:
-    """Interacts with Multipass as a VM middle-layer"""
+    """Interacts with Multipass as a VM middle-layer. Instance state is read from a single
+    `multipass info --all` snapshot, memoised until a mutation invalidates it. The snapshot is
+    also shared between processes through a short-lived file, so repeated `box ip` calls
+    do not each wait on multipass."""
+    state: Optional[dict] = None
+
+    # -- the modification time of the shared snapshot the memoised one matches, if any
+    taken: Optional[float] = None
+
+    # -- how many seconds a snapshot on disk is trusted for
+    cache_ttl: float = 5.0
+
+    @staticmethod
+    def cache_path() -> Path:
+        return cache_dir() / 'instances.json'
+
     @classmethod
-    def list(cls):
-        output = subprocess.check_output(
-            ['multipass', 'ls', '--format', 'json'])
-        info = json.loads(output)
+    def read_cache(cls) -> Optional[dict]:
+        """Read the on-disk snapshot, if it is recent enough"""
+        try:
+            mtime = os.path.getmtime(Multipass.cache_path())
+
+            if time.time() - mtime > cls.cache_ttl:
+                return None
+
+            with open(Multipass.cache_path()) as conn:
+                state = json.load(conn)
+        except (OSError, ValueError):
+            return None
+
+        cls.taken = mtime
+        return state
+
+    @classmethod
+    def write_cache(cls, state: dict) -> None:
+        """Atomically replace the on-disk snapshot. The snapshot is only an optimisation, so failing
+        to write it is not an error"""
+        tmp_path = None
+        cls.taken = None
+
+        try:
+            # -- a unique temporary file, as a fleet's boxes write the snapshot from several threads at once
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir(), prefix='instances.', suffix='.tmp')
+
+            with os.fdopen(fd, 'w') as conn:
+                json.dump(state, conn)
+
+            mtime = os.path.getmtime(tmp_path)
+            os.replace(tmp_path, Multipass.cache_path())
+            cls.taken = mtime
+        except OSError as err:
+            logging.info(f'📦 could not cache the instance state: {err}')
+
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        """Fetch the state of every instance in one call, reusing it until invalidated"""
+        if cls.state is not None:
+            return cls.state
+
+        cls.state = cls.read_cache()
+
+        if cls.state is not None:
+            return cls.state
 
-        return info['list']
+        with Tracer.span('multipass info'):
+            proc = subprocess.run(['multipass', 'info', '--all', '--format', 'json'],
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        if proc.returncode != 0:
+            msg = proc.stderr.decode('utf8')
+
+            if 'No instances' not in msg:
+                raise Exception(f'an error: {msg.strip()}')
+
+            cls.state = {}
+            cls.write_cache(cls.state)
+            return cls.state
+
+        info = json.loads(proc.stdout)
+
+        for error in info['errors']:
+            raise Exception(f'an error: {error}')
+
+        cls.state = info['info']
+        cls.write_cache(cls.state)
+        return cls.state
+
+    @classmethod
+    def invalidate(cls) -> None:
+        """Discard the memoised snapshot, and the one shared on disk, after an instance was changed"""
+        cls.state = None
+
+        try:
+            os.remove(Multipass.cache_path())
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def outdated(cls) -> bool:
+        """Has another process changed an instance since the memoised snapshot was taken? Processes
+        remove the shared snapshot when they change an instance, and only replace it with newer ones"""
+        try:
+            return os.path.getmtime(Multipass.cache_path()) != cls.taken
+        except OSError:
+            return True
+
+    @classmethod
+    def list(cls):
+        return [{'name': name, **inst} for name, inst in Multipass.snapshot().items()]
 
     @classmethod
     def running_vms(cls):
         """List VMs that are currently running."""
-        info = Multipass.list()
-
         running = set()
 
-        for inst in info:
+        for name, inst in Multipass.snapshot().items():
             if inst['state'] == 'Running':
-                running.add(inst['name'])
+                running.add(name)
 
         return running
 
     @classmethod
     def info(cls, name: str) -> Optional[dict]:
         """Retrieve info about a running instance"""
-        running = Multipass.running_vms()
-        if not name in running:
+        inst = Multipass.snapshot().get(name)
+
+        if not inst or inst['state'] != 'Running':
             return None
 
-        output = subprocess.check_output(
-            ['multipass', 'info', name, '--format', 'json'])
-        info = json.loads(output)
+        return inst
 
-        for error in info['errors']:
-            raise Exception(f'an error: {error}')
+    @classmethod
+    def ip(cls, name: str) -> Optional[str]:
+        """Retrieve the first IPv4 address of a running instance"""
+        info = Multipass.info(name)
+        return info['ipv4'][0] if info and info.get('ipv4') else None
+
+    @staticmethod
+    def launch_args(opts: dict):
+        return ['multipass', 'launch', '-n', opts['name'],
+                '--cloud-init', '-',
+                '-d', opts['disk'], '-m', opts['ram'], opts['image']]
 
-        return info['info'][name]
+    @staticmethod
+    def launch_failed(msg: str) -> None:
+        """Report a failed launch, and exit"""
+
+        if 'Remote "" is unknown or unreachable.' in msg:
+            logging.error(
+                'Cannot launch due to known issue with Multipass. Try running: sudo snap restart multipass')
+            exit(1)
+        elif "cannot connect to the multipass socket" in msg:
+            logging.error(
+                'Cannot connect to multipass. Try running: sudo snap restart multipass')
+            exit(1)
+        else:
+            logging.error(msg)
+            exit(1)
 
     @classmethod
-    def launch(cls, opts: dict):
-        """Launch a VM with the provided configuration"""
+    async def launch_async(cls, opts: dict):
+        """Launch a VM with the provided configuration, without blocking the event loop"""
+        import asyncio
 
-        name = opts['name']
-        config = opts['config']
-        ram = opts['ram']
-        disk = opts['disk']
-        image = opts['image']
+        proc = await asyncio.create_subprocess_exec(*Multipass.launch_args(opts),
+                                                    stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.STDOUT)
+        output, _ = await proc.communicate(opts['config'].encode())
 
-        try:
-            subprocess.check_output(['multipass', 'launch', '-n', name,
-                                     '--cloud-init', '-',
-                                     '-d', disk, '-m', ram, image], stderr=subprocess.STDOUT,
-                                    input=config.encode())
-        except subprocess.CalledProcessError as err:
-            # -- handle launch errors
+        Multipass.invalidate()
 
-            msg = err.output.decode('utf8')
+        if proc.returncode != 0:
+            Multipass.launch_failed(output.decode('utf8'))
+
+    @classmethod
+    async def clone_async(cls, source: str, name: str, opts: dict):
+        """Clone a stopped instance into a new instance, resized to the provided ram and disk"""
+        import asyncio
 
-            if 'Remote "" is unknown or unreachable.' in msg:
-                logging.error(
-                    'Cannot launch due to known issue with Multipass. Try running: sudo snap restart multipass')
-                exit(1)
-            elif "cannot connect to the multipass socket" in msg:
-                logging.error(
-                    'Cannot connect to multipass. Try running: sudo snap restart multipass')
-                exit(1)
-            else:
-                logging.error(msg)
-                exit(1)
+        proc = await asyncio.create_subprocess_exec('multipass', 'clone', source, '-n', name,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.STDOUT)
+        output, _ = await proc.communicate()
+
+        Multipass.invalidate()
+
+        if proc.returncode != 0:
+            logging.error(f'Failed to clone {source} into {name}, multipass 1.15 or later is required: {output.decode("utf8").strip()}')
+            exit(1)
+
+        for setting, value in [('memory', opts['ram']), ('disk', opts['disk'])]:
+            proc = await asyncio.create_subprocess_exec('multipass', 'set', f'local.{name}.{setting}={value}',
+                                                        stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.STDOUT)
+            output, _ = await proc.communicate()
+
+            # -- disks can only grow, so an unchanged disk size is reported but harmless
+            if proc.returncode != 0:
+                logging.warning(f'could not set {setting} of {name}: {output.decode("utf8").strip()}')
+
+        proc = await asyncio.create_subprocess_exec('multipass', 'start', name)
+        await proc.wait()
+
+        Multipass.invalidate()
 
     @classmethod
     def stop(cls, name: str):
@@ -85,28 +229,86 @@ class Multipass:
         except subprocess.CalledProcessError as err:
             logging.error('Failed to stop VM through multipass')
             exit(1)
+        finally:
+            Multipass.invalidate()
 
     @classmethod
     def start(cls, name: str):
-        """Start a stopped VM"""
+        """Start a stopped or suspended VM"""
 
-        for vm in Multipass.list():
-            if vm['name'] == name:
-                if vm['state'] == 'Stopped':
-                    subprocess.run(['multipass', 'start', name])
-            return
+        vm = Multipass.snapshot().get(name)
+
+        if not vm:
+            logging.error(f'vm {name} does not exist')
+            exit(1)
 
-        logging.error(f'vm {name} does not exist')
-        exit(1)
+        # -- starting a suspended VM resumes it from its saved memory state
+        if vm['state'] in ('Stopped', 'Suspended'):
+            subprocess.run(['multipass', 'start', name])
+            Multipass.invalidate()
+
+    @classmethod
+    def suspend(cls, name: str):
+        """Suspend a running VM, keeping its memory state so it resumes without booting"""
+
+        proc = subprocess.run(['multipass', 'suspend', name], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        Multipass.invalidate()
+
+        if proc.returncode != 0:
+            logging.error(f'Failed to suspend {name} through multipass: {proc.stdout.decode("utf8").strip()}')
+            exit(1)
+
+    @classmethod
+    def mount(cls, source: str, name: str, target: str):
+        """Mount a host directory into a VM"""
+
+        proc = subprocess.run(['multipass', 'mount', source, f'{name}:{target}'],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        Multipass.invalidate()
+
+        if proc.returncode != 0:
+            logging.error(f'Failed to mount {source} into {name}: {proc.stdout.decode("utf8").strip()}')
+            exit(1)
+
+    @classmethod
+    def umount(cls, name: str, target: str):
+        """Unmount a host directory from a VM"""
+
+        subprocess.run(['multipass', 'umount', f'{name}:{target}'],
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        Multipass.invalidate()
+
+    @classmethod
+    def sync_mounts(cls, name: str, entries: Iterable[dict]):
+        """Mount each entry's src at its dest in a running VM, unless it is already mounted there.
+        Relative destinations are relative to root's home, as they are for copies"""
+        inst = Multipass.snapshot().get(name) or {}
+        mounts = inst.get('mounts') or {}
+
+        for entry in entries:
+            source = os.path.abspath(entry['src'])
+            target = str(entry['dest'] if entry['dest'].is_absolute() else Path('/root') / entry['dest'])
+            mounted = mounts.get(target)
+
+            if mounted and mounted.get('source_path') == source:
+                continue
+
+            # -- the target holds a different host directory, from an earlier box.yaml
+            if mounted:
+                Multipass.umount(name, target)
+
+            with Tracer.span('mount', src=source, dest=target):
+                Multipass.mount(source, name, target)
+
+            logging.info(f'📦 mounted {source} at {target}')
 
     @classmethod
     def delete(cls, name: str):
         """Delete vm by name"""
 
-        listed = Multipass.list()
-
-        if not any([list['name'] == name for list in listed]):
+        if name not in Multipass.snapshot():
             subprocess.run(['multipass', 'purge'])
+            Multipass.invalidate()
             return
 
         try:
@@ -115,3 +317,5 @@ class Multipass:
         except subprocess.CalledProcessError as err:
             logging.error('Failed to delete VM through multipass')
             exit(1)
+        finally:
+            Multipass.invalidate()
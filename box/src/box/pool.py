@@ -0,0 +1,199 @@
+
+import os
+import sys
+import json
+import hashlib
+import secrets
+import time
+import subprocess
+from pathlib import Path
+from typing import Optional
+from contextlib import contextmanager
+
+from .box_config import BoxConfig
+from .multipass import Multipass
+from .utils import logging, cache_dir
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class WarmPool:
+    """Spare instances, launched and bootstrapped ahead of time then stopped, that `box up` claims
+    instead of launching a new instance. Multipass cannot rename instances, so a claimed spare keeps
+    its name, and the registry maps the box's name to it. Spares are keyed by a hash of the rendered
+    cloud-init and the instance size, so a box only claims a spare bootstrapped the way it would be."""
+    PREFIX = 'box-pool-'
+
+    @staticmethod
+    def registry_path() -> Path:
+        return cache_dir() / 'pool.json'
+
+    @staticmethod
+    def key(cfg: BoxConfig, cloud_init: str) -> str:
+        digest = hashlib.sha256(cloud_init.encode('utf8'))
+        digest.update(f'{cfg.memory} {cfg.disk}'.encode('utf8'))
+
+        return digest.hexdigest()[:12]
+
+    @staticmethod
+    def read() -> dict:
+        """The registry of spares, by instance name, and of claimed spares, by box name"""
+        try:
+            with open(WarmPool.registry_path()) as conn:
+                registry = json.load(conn)
+        except (FileNotFoundError, ValueError):
+            registry = {}
+
+        registry.setdefault('spares', {})
+        registry.setdefault('aliases', {})
+
+        return registry
+
+    @staticmethod
+    @contextmanager
+    def locked():
+        """Hold the registry lock, and yield the registry; it is saved when the block exits"""
+        with open(cache_dir() / 'pool.lock', 'a') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+            registry = WarmPool.read()
+
+            yield registry
+
+            tmp_path = WarmPool.registry_path().with_suffix(f'.{os.getpid()}.tmp')
+
+            with open(tmp_path, 'w') as conn:
+                json.dump(registry, conn, indent=2)
+
+            os.replace(tmp_path, WarmPool.registry_path())
+
+    @staticmethod
+    def resolve(name: str) -> str:
+        """The instance backing a box; a claimed spare, or the instance of the same name"""
+        instance = WarmPool.aliases().get(name)
+
+        return instance if instance and instance in Multipass.snapshot() else name
+
+    @staticmethod
+    def aliases() -> dict:
+        if not os.path.exists(WarmPool.registry_path()):
+            return {}
+
+        return WarmPool.read()['aliases']
+
+    @staticmethod
+    def claim(name: str, key: str) -> Optional[str]:
+        """Take a spare matching key for the box name, returning the spare's instance name"""
+        instances = Multipass.snapshot()
+
+        with WarmPool.locked() as registry:
+            # -- forget spares deleted outside box
+            registry['spares'] = {spare: spare_key for spare, spare_key in registry['spares'].items()
+                                  if spare in instances}
+
+            for spare, spare_key in registry['spares'].items():
+                if spare_key == key:
+                    del registry['spares'][spare]
+                    registry['aliases'][name] = spare
+
+                    return spare
+
+        return None
+
+    @staticmethod
+    def forget(name: str) -> None:
+        """Drop a box's alias, once its instance is deleted"""
+        if name not in WarmPool.aliases():
+            return
+
+        with WarmPool.locked() as registry:
+            registry['aliases'].pop(name, None)
+
+    @staticmethod
+    def spares(key: Optional[str] = None) -> list[str]:
+        """Spares that still exist, optionally only those matching key"""
+        spares = WarmPool.read()['spares']
+
+        if not spares:
+            return []
+
+        instances = Multipass.snapshot()
+
+        return [spare for spare, spare_key in spares.items()
+                if spare in instances and (key is None or spare_key == key)]
+
+    @staticmethod
+    async def launch_spare(cfg: BoxConfig, cloud_init: str, key: str) -> None:
+        """Launch and bootstrap one spare, then stop it and add it to the pool"""
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        name = f'{WarmPool.PREFIX}{key}-{secrets.token_hex(3)}'
+
+        await Multipass.launch_async({
+            'name': name,
+            'config': cloud_init,
+            'ram': cfg.memory,
+            'disk': cfg.disk,
+            'image': 'ubuntu'
+        })
+
+        await loop.run_in_executor(None, Multipass.stop, name)
+
+        with WarmPool.locked() as registry:
+            registry['spares'][name] = key
+
+        logging.info(f'📦 added {name} to the warm pool')
+
+    @staticmethod
+    async def fill(cfg: BoxConfig, cloud_init: str, size: int, concurrency: int = 4) -> None:
+        """Launch spares until size of them match this configuration"""
+        import asyncio
+
+        key = WarmPool.key(cfg, cloud_init)
+        missing = size - len(WarmPool.spares(key))
+        start_time = time.monotonic()
+
+        if missing <= 0:
+            logging.info(f'📦 the warm pool already holds {size} spares for this configuration')
+            return
+
+        logging.info(f'📦 launching {missing} spares for the warm pool...')
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def launch():
+            async with semaphore:
+                await WarmPool.launch_spare(cfg, cloud_init, key)
+
+        await asyncio.gather(*[launch() for _ in range(missing)])
+
+        seconds_elapsed = round(time.monotonic() - start_time)
+        logging.info(f'📦 the warm pool holds {size} spares for this configuration (+{seconds_elapsed}s)')
+
+    @staticmethod
+    def drain() -> None:
+        """Delete every unclaimed spare"""
+        for spare in WarmPool.spares():
+            logging.info(f'📦 deleting spare {spare}')
+            Multipass.delete(spare)
+
+        with WarmPool.locked() as registry:
+            registry['spares'] = {}
+
+    @staticmethod
+    def detach(argv: list[str]) -> None:
+        """Re-run a `box pool fill` command in the background, logging its progress to a file"""
+        folder = cache_dir() / 'logs'
+        folder.mkdir(exist_ok=True)
+        log = folder / 'pool-fill.log'
+
+        with open(log, 'a') as conn:
+            proc = subprocess.Popen([sys.executable, os.path.abspath(argv[0]), *argv[1:], '--wait'],
+                                    stdin=subprocess.DEVNULL, stdout=conn, stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+
+        logging.info(f'📦 filling the warm pool in the background (pid {proc.pid}); progress is logged to {log}')
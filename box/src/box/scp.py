@@ -1,48 +1,160 @@
 
 import os
-import logging
+import time
+import shlex
+import tarfile
 from pathlib import Path
 import paramiko
+from typing import Callable, Optional
 
 from .ssh import SSH
+from .connections import ConnectionPool
+from .transfer import TransferEngine, throughput
+from .tracing import Tracer
+
+
+class ChannelWriter:
+    """A minimal writable file over a channel. tarfile's stream mode already writes in whole records,
+    so this skips the extra buffering (and finaliser) of channel.makefile"""
+
+    def __init__(self, channel: paramiko.Channel) -> None:
+        self.channel = channel
+        self.hung_up = False
+
+    def write(self, data: bytes) -> int:
+        try:
+            self.channel.sendall(data)
+        except OSError:
+            # -- recorded, so a failed send is not mistaken for a failure reading the local tree
+            self.hung_up = True
+            raise
+
+        return len(data)
 
 
 class SCP:
     """Manage SSH connections"""
     ip: str
     user: str
-    client: paramiko.SSHClient
+    key_type: Optional[str]
 
-    def __init__(self, user: str, ip: str) -> None:
+    def __init__(self, user: str, ip: str, key_type: Optional[str] = None) -> None:
         self.user = user
         self.ip = ip
-
-        logging.getLogger("paramiko").setLevel(logging.WARNING)
-
-        self.client = paramiko.SSHClient()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.key_type = key_type
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback) -> None:
-        self.client.close()
+        # -- the transport belongs to the connection pool, and is reused by later copies
+        pass
 
-    def copy(self, folder: Path, src: Path, dest: Path) -> None:
+    def copy(self, folder: Path, src: Path, dest: Path, compress: bool = False) -> None:
         """Copy a file or folder from a local source to a remote destination"""
 
-        _, ssh_private_path = SSH.save_keypair(folder)
+        _, ssh_private_path = SSH.save_keypair(folder, self.key_type)
+
+        if os.path.isdir(src):
+            self.copy_tree(ssh_private_path, src, dest, compress)
+            return
 
-        key = paramiko.RSAKey.from_private_key_file(
-            str(ssh_private_path), password='')
+        sftp = ConnectionPool.sftp(self.user, self.ip, ssh_private_path)
 
-        self.client.connect(self.ip, username=self.user,
-                            pkey=key)
+        with Tracer.span('copy', src=str(src), dest=str(dest)) as span:
+            start_time = time.monotonic()
+            span['bytes'] = sftp.put(str(src), str(dest)).st_size
+            span['throughput'] = throughput(span['bytes'], time.monotonic() - start_time)
 
-        sftp = self.client.open_sftp()
+    def copy_many(self, folder: Path, jobs: list[tuple[Path, Path]], workers: int = 4,
+                  on_done: Optional[Callable] = None) -> list[dict]:
+        """Copy many (src, dest) files concurrently over one transport"""
 
-        if os.path.isdir(src):
-            raise NotImplementedError(f'cannot copy {src}, as directory copies are not yet implemented')
+        _, ssh_private_path = SSH.save_keypair(folder, self.key_type)
+
+        engine = TransferEngine(self.user, self.ip, ssh_private_path, workers)
+        return engine.upload(jobs, on_done)
+
+    def copy_tree(self, key_path: Path, src: Path, dest: Path, compress: bool = False) -> None:
+        """Stream a directory to the remote host as a tar archive, through a single exec channel.
+        The archive is written block-by-block as the tree is walked, so nothing is staged in memory or on disk."""
+
+        client = ConnectionPool.client(self.user, self.ip, key_path)
+
+        target = shlex.quote(str(dest))
+        flags = '-xzf' if compress else '-xf'
+
+        channel = client.get_transport().open_session()
+        channel.exec_command(
+            f'mkdir -p {target} && tar {flags} - --no-same-owner -C {target}')
+
+        stream = ChannelWriter(channel)
+
+        with Tracer.span('copy tree', src=str(src), dest=str(dest), compress=compress) as span:
+            start_time = time.monotonic()
+
+            try:
+                with tarfile.open(fileobj=stream, mode='w|gz' if compress else 'w|') as archive:
+                    archive.add(str(src), arcname='.')
+
+                span['bytes'] = sum(member.size for member in archive.members)
+                span['throughput'] = throughput(span['bytes'], time.monotonic() - start_time)
+            except OSError:
+                # -- the remote end hung up early; report its exit status and stderr below. Anything
+                # -- else, such as a local file that cannot be read, leaves a truncated archive, which
+                # -- tar unpacks without complaint, so it must fail the copy
+                if not stream.hung_up:
+                    channel.close()
+                    raise
+            finally:
+                channel.shutdown_write()
+
+            status = channel.recv_exit_status()
+
+        if status != 0 or stream.hung_up:
+            message = channel.makefile_stderr('rb').read().decode('utf8', errors='replace')
+            channel.close()
+            raise IOError(f'failed unpacking {src} into {dest} (exit {status}): {message.strip()}')
+
+        channel.close()
+
+    def read_text(self, folder: Path, path: Path) -> Optional[str]:
+        """Read a remote text file, returning None if it does not exist"""
+
+        _, ssh_private_path = SSH.save_keypair(folder, self.key_type)
+        sftp = ConnectionPool.sftp(self.user, self.ip, ssh_private_path)
+
+        try:
+            with sftp.open(str(path), 'r') as conn:
+                return conn.read().decode('utf8')
+        except FileNotFoundError:
+            return None
+
+    def clear(self, folder: Path, path: Path) -> None:
+        """Remove the files in a remote folder, if it exists"""
+
+        _, ssh_private_path = SSH.save_keypair(folder, self.key_type)
+        sftp = ConnectionPool.sftp(self.user, self.ip, ssh_private_path)
+
+        try:
+            names = sftp.listdir(str(path))
+        except FileNotFoundError:
+            return
+
+        for name in names:
+            sftp.remove(str(path / name))
+
+    def write_text(self, folder: Path, path: Path, content: str) -> None:
+        """Write a remote text file, creating its parent folders if required"""
+
+        _, ssh_private_path = SSH.save_keypair(folder, self.key_type)
+        sftp = ConnectionPool.sftp(self.user, self.ip, ssh_private_path)
+
+        for parent in reversed(path.parents[:-1]):
+            try:
+                sftp.stat(str(parent))
+            except FileNotFoundError:
+                sftp.mkdir(str(parent))
 
-        # -- update to support directories
-        sftp.put(str(src), str(dest))
+        with sftp.open(str(path), 'w') as conn:
+            conn.write(content.encode('utf8'))
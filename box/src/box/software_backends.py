@@ -1,19 +1,45 @@
 
+import os
+import json
+import shlex
+import shutil
+import hashlib
+import subprocess
 from abc import abstractmethod
 from pathlib import Path
+from typing import Optional
 import time
 import yaml
 
 from .box_config import BoxConfig
 from .ssh import SSH
+from .ssh_config import SSHConfig
 from .scp import SCP
-from .utils import logging
+from .connections import ConnectionPool
+from .manifest import Manifest, REMOTE_STATE
+from .ledger import Ledger
+from .tracing import Tracer, ANSIBLE_CALLBACK
+from .streaming import RingLog, ProcessStreamer
+from .artifacts import ArtifactCache, setup_script, TEARDOWN_SCRIPT
+from .utils import logging, cache_dir
 from abc import ABC, abstractmethod
 
 
-def inventory_config(ip: str) -> str:
+def inventory_config(name: str, key_path: Path) -> str:
+    """An inventory reaching the instance through its ssh config alias. The host is named localhost,
+    so playbooks written for the bootstrapped configurator, which targets localhost, apply unchanged"""
     return yaml.dump({
-        'all': {'hosts': ip}
+        'all': {
+            'hosts': {
+                'localhost': {
+                    'ansible_connection': 'ssh',
+                    'ansible_host': name,
+                    'ansible_user': 'root',
+                    'ansible_ssh_private_key_file': str(key_path),
+                    'ansible_python_interpreter': '/usr/bin/python3'
+                }
+            }
+        }
     })
 
 
@@ -24,7 +50,7 @@ class VMConfigurator(ABC):
         pass
 
     @abstractmethod
-    def configure(self, cfg: BoxConfig) -> None:
+    def configure(self, cfg: BoxConfig, opts: Optional[dict] = None) -> None:
         pass
 
     @abstractmethod
@@ -37,44 +63,389 @@ class AnsibleConfiguration(VMConfigurator):
     name: str
     ip: str
     cfg: BoxConfig
+    opts: dict
+    failures: list[str]
 
     def __init__(self, name: str, ip: str) -> None:
         self.name = name
         self.ip = ip
 
-    def configure(self, cfg: BoxConfig) -> None:
+    def configure(self, cfg: BoxConfig, opts: Optional[dict] = None) -> None:
         self.cfg = cfg
+        self.opts = opts or {}
 
     def create_config(self) -> str:
-        raise NotImplementedError(
-            'no default ansible configuration, extend and provide your own')
+        """Create the ansible.cfg used on the instance. Facts are cached between the playbooks of a run,
+        and only gathered when missing; extend and override to provide your own"""
+        tracing = [
+            f'callback_plugins = ~/{REMOTE_STATE}/callback_plugins',
+            'callbacks_enabled = box_trace'
+        ] if Tracer.detailed else []
+
+        return '\n'.join([
+            '[defaults]',
+            'gathering = smart',
+            'fact_caching = jsonfile',
+            f'fact_caching_connection = ~/{REMOTE_STATE}/facts',
+            'fact_caching_timeout = 86400',
+            *tracing,
+            '',
+            '[ssh_connection]',
+            'pipelining = True',
+            ''
+        ])
+
+    def create_site(self, names: list[str]) -> str:
+        """Create a wrapper playbook that imports each playbook, so they run in one ansible-playbook session"""
+        return yaml.dump([{'import_playbook': f'../{name}'} for name in names])
+
+    def fingerprint(self, playbook: Path, manifest: Manifest) -> str:
+        return Ledger.fingerprint(playbook, self.cfg, manifest)
+
+    def stage(self, scp: SCP, manifest: Manifest, pending: list[tuple]) -> int:
+        """Upload ansible.cfg, the tracing plugin if profiling, and each pending playbook to the instance.
+        Returns the number of playbooks the instance already held"""
+        skipped = 0
+
+        # -- facts only last one run; an instance cloned from a golden image would otherwise use its facts
+        scp.clear(self.cfg.key_folder, REMOTE_STATE / 'facts')
+        scp.write_text(self.cfg.key_folder, REMOTE_STATE / 'ansible.cfg', self.create_config())
+
+        if Tracer.detailed:
+            scp.write_text(self.cfg.key_folder, REMOTE_STATE / 'callback_plugins' / 'box_trace.py', ANSIBLE_CALLBACK)
+
+        for playbook, name, _ in pending:
+            if not self.sync(scp, manifest, playbook, Path(name)):
+                skipped += 1
+
+        return skipped
+
+    def target(self, playbook: Path, name: str) -> Path:
+        """The path ansible-playbook is given for a staged playbook"""
+        return Path(name)
+
+    def site(self, scp: SCP, pending: list[tuple]) -> Path:
+        """Stage a wrapper playbook importing every pending playbook, returning its path"""
+        scp.write_text(self.cfg.key_folder, REMOTE_STATE / 'site.yaml',
+                       self.create_site([name for _, name, _ in pending]))
+
+        return REMOTE_STATE / 'site.yaml'
+
+    def sync(self, scp: SCP, manifest: Manifest, src: Path, dest: Path, compress: bool = False) -> bool:
+        """Copy src to dest, unless the instance already holds identical content. Returns whether a copy was made"""
+        fingerprint = manifest.changed(src, dest)
+
+        if fingerprint is None and not self.opts.get('force'):
+            return False
+
+        scp.copy(self.cfg.key_folder, src, dest, compress)
+        manifest.record(dest, fingerprint or manifest.fingerprint(src))
+
+        return True
+
+    def copy_entries(self, scp: SCP, manifest: Manifest) -> int:
+        """Copy changed entries to the instance. Directories are streamed one at a time, while
+        files are uploaded concurrently. Files cloud-init already wrote during first boot are only
+        recorded. Returns the number of unchanged entries skipped"""
+        skipped = 0
+        files = []
+        fingerprints = {}
+        preseeded = self.opts.get('preseeded', [])
+
+        for entry in self.cfg.copy:
+            src = entry['src']
+            dest = entry['dest']
+
+            # -- mounted entries are read from the host in place
+            if entry['mode'] == 'mount':
+                continue
+
+            if str(dest) in preseeded:
+                # -- cloud-init wrote this file during first boot, so it only needs recording
+                manifest.record(dest, manifest.fingerprint(src))
+                continue
+
+            if os.path.isdir(src):
+                try:
+                    if not self.sync(scp, manifest, src, dest, entry['compress']):
+                        skipped += 1
+                except:
+                    raise IOError(f'failed copying {src} to {dest}')
+
+                continue
+
+            fingerprint = manifest.changed(src, dest)
+
+            if fingerprint is None and not self.opts.get('force'):
+                skipped += 1
+                continue
+
+            fingerprints[str(dest)] = fingerprint or manifest.fingerprint(src)
+            files.append((src, dest))
+
+        if files:
+            scp.copy_many(self.cfg.key_folder, files, self.cfg.transfer_workers,
+                          on_done=lambda src, dest: manifest.record(dest, fingerprints[str(dest)]))
+
+        if preseeded:
+            logging.info(f'📦 {len(preseeded)} small files were written by cloud-init during first boot')
+
+        return skipped
+
+    def playbook_command(self, playbook: Path) -> str:
+        cmd = f'ANSIBLE_CONFIG={REMOTE_STATE}/ansible.cfg ansible-playbook -i "localhost, " -c local {playbook}'
+
+        if Tracer.detailed:
+            cmd = f'MYSTERY_BOX_TRACE={REMOTE_STATE}/trace.jsonl {cmd}'
+
+        if self.cfg.vars:
+            cmd += f" --extra-vars {shlex.quote(json.dumps(self.cfg.vars))}"
+
+        return cmd
+
+    def log_path(self, playbook: Path) -> Path:
+        folder = cache_dir() / 'logs'
+        folder.mkdir(exist_ok=True)
+
+        return folder / f'{self.name}-{Path(playbook).stem}-{time.strftime("%Y%m%d-%H%M%S")}.log.gz'
+
+    def execute(self, playbook: Path, log: Path) -> int:
+        """Run ansible-playbook, returning its exit status"""
+
+        # -- use ssh to call ansible on the remote host, to configure its own host on localhost.
+        with SSH(user='root', ip=self.ip, cfg=self.cfg) as ssh:
+            return ssh.run(self.cfg.key_folder, self.playbook_command(playbook), log, self.name)
+
+    def apply(self, playbook: Path) -> bool:
+        """Apply a staged playbook, returning whether it succeeded"""
+        log = self.log_path(playbook)
+
+        with Tracer.span('playbook', playbook=str(playbook)) as span:
+            status = self.execute(playbook, log)
+            span['status'] = status
+
+        if Tracer.detailed:
+            self.collect_trace()
+
+        if status != 0:
+            logging.error(f'📦 {playbook} failed with exit status {status}; output saved to {log}')
+            self.failures.append(str(playbook))
+
+        return status == 0
+
+    def use_artifact_cache(self, enabled: bool) -> None:
+        """Point apt and pip on the instance at the host's artifact cache, or stop them using it"""
+        cmd = setup_script(ArtifactCache.port) if enabled else TEARDOWN_SCRIPT
+
+        with SSH(user='root', ip=self.ip, cfg=self.cfg) as ssh:
+            ssh.run(self.cfg.key_folder, cmd)
+
+    def collect_trace(self) -> None:
+        """Record the task spans written by the box_trace callback plugin, then clear them for the next playbook"""
+        trace_path = REMOTE_STATE / 'trace.jsonl'
+
+        with SCP(user='root', ip=self.ip, key_type=self.cfg.key_type) as scp:
+            content = scp.read_text(self.cfg.key_folder, trace_path)
+
+            if content:
+                Tracer.record_ansible(content, f'{self.name} ansible')
+                scp.write_text(self.cfg.key_folder, trace_path, '')
 
     def run(self) -> None:
         """Run an ansible playbook on the remote host."""
         start_time = time.monotonic()
+        ConnectionPool.reset_stats(self.ip)
+
+        manifest = Manifest(self.name)
+        ledger = Ledger()
+        skipped = 0
+        cached = False
+        self.failures = []
 
         # -- first, copy all required resources over.
-        with SCP(user='root', ip=self.ip) as scp:
-            for entry in self.cfg.copy:
-                try:
-                    scp.copy(self.cfg.key_folder, entry['src'], entry['dest'])
-                except:
-                    raise IOError(
-                        f"failed copying {entry['src']} to {entry['dest']}")
+        with SCP(user='root', ip=self.ip, key_type=self.cfg.key_type) as scp:
+            manifest.load_remote(scp, self.cfg.key_folder)
+            ledger.load(scp, self.cfg.key_folder)
+
+            try:
+                with Tracer.span('copy entries') as span:
+                    span['skipped'] = self.copy_entries(scp, manifest)
+                    skipped += span['skipped']
+
+                pending = []
+                for playbook in self.cfg.playbooks:
+                    name = Path(playbook).name
+                    fingerprint = self.fingerprint(playbook, manifest)
+
+                    if not self.opts.get('all') and ledger.unchanged(name, fingerprint):
+                        logging.info(f'📦 skipping {name}, unchanged since it was last applied; use --all to apply it anyway')
+                        continue
+
+                    pending.append((playbook, name, fingerprint))
+
+                if pending:
+                    skipped += self.stage(scp, manifest, pending)
+
+                if pending and self.cfg.artifact_cache:
+                    self.use_artifact_cache(True)
+                    cached = True
+
+                if pending and self.cfg.single_session:
+                    # -- apply every playbook together, so facts are gathered once
+                    if self.apply(self.site(scp, pending)):
+                        for _, name, fingerprint in pending:
+                            ledger.record(name, fingerprint)
+
+                        ledger.save(scp, self.cfg.key_folder)
+                else:
+                    for playbook, name, fingerprint in pending:
+                        if self.apply(self.target(playbook, name)):
+                            ledger.record(name, fingerprint)
+                            ledger.save(scp, self.cfg.key_folder)
+            finally:
+                if cached:
+                    self.use_artifact_cache(False)
 
-            for playbook in self.cfg.playbooks:
-                scp.copy(self.cfg.key_folder, playbook,
-                         Path(Path(playbook).name))
+                # -- record whatever was uploaded, even if a later step failed
+                manifest.save_remote(scp, self.cfg.key_folder)
+                manifest.save_host()
 
-                # -- use ssh to call ansible on the remote host, to configure its own host on localhost.
-                with SSH(user='root', ip=self.ip, cfg=self.cfg) as ssh:
-                    ssh.run(self.cfg.key_folder,
-                        f'ansible-playbook -i "localhost, " -c local {Path(Path(playbook).name)}')
+            if skipped:
+                logging.info(f'📦 skipped {skipped} unchanged entries; use --force to upload them anyway')
+
+            if self.failures:
+                logging.error(f'📦 {self.name} configuration failed: {", ".join(self.failures)}')
+                exit(1)
 
             seconds_elapsed = round(time.monotonic() - start_time)
             logging.info(
-                f'📦 devbox configured and ready to use at {self.ip} (+{seconds_elapsed}s)')
+                f'📦 {self.name} configured and ready to use at {self.ip} (+{seconds_elapsed}s, {ConnectionPool.summary(self.ip)})')
+
+
+class AnsiblePushConfiguration(AnsibleConfiguration):
+    """Configure a VM by running Ansible on the host, over SSH with pipelining and a persistent master
+    connection, rather than bootstrapping Ansible onto the instance. Playbooks run from where they are,
+    so they can use roles and other files beside them"""
+
+    # -- folders beside a playbook that ansible-playbook reads, so part of the playbook's fingerprint
+    PLAYBOOK_FOLDERS = ['roles', 'group_vars', 'host_vars', 'vars', 'files', 'templates', 'library']
+
+    def configure(self, cfg: BoxConfig, opts: Optional[dict] = None) -> None:
+        if not shutil.which('ansible-playbook'):
+            logging.error('📦 the push configurator runs ansible-playbook on this machine, but it is not installed')
+            exit(1)
+
+        super().configure(cfg, opts)
+
+    def folder(self) -> Path:
+        folder = cache_dir() / 'ansible' / self.name
+        folder.mkdir(parents=True, exist_ok=True)
+
+        return folder
+
+    def create_config(self) -> str:
+        """Create the ansible.cfg used on the host. Connections go through the box's ssh config,
+        so they share its pinned host key and ControlMaster connection"""
+        folder = self.folder()
+        tracing = [
+            f'callback_plugins = {folder}/callback_plugins',
+            'callbacks_enabled = box_trace'
+        ] if Tracer.detailed else []
+
+        return '\n'.join([
+            '[defaults]',
+            f'inventory = {folder}/inventory.yaml',
+            'gathering = smart',
+            'fact_caching = jsonfile',
+            f'fact_caching_connection = {folder}/facts',
+            'fact_caching_timeout = 86400',
+            *tracing,
+            '',
+            '[ssh_connection]',
+            'pipelining = True',
+            f'ssh_args = -F {SSHConfig(self.name).config_path}',
+            ''
+        ])
+
+    def create_site(self, playbooks: list[str]) -> str:
+        return yaml.dump([{'import_playbook': str(Path(playbook).resolve())} for playbook in playbooks])
+
+    def fingerprint(self, playbook: Path, manifest: Manifest) -> str:
+        """Fingerprint a playbook together with the roles and other files it reads"""
+        digest = hashlib.sha256(super().fingerprint(playbook, manifest).encode('utf8'))
+
+        for name in AnsiblePushConfiguration.PLAYBOOK_FOLDERS:
+            fpath = Path(playbook).resolve().parent / name
+
+            if fpath.is_dir():
+                digest.update(name.encode('utf8'))
+                digest.update(manifest.fingerprint(fpath)['sha256'].encode('utf8'))
+
+        return digest.hexdigest()
+
+    def stage(self, scp: SCP, manifest: Manifest, pending: list[tuple]) -> int:
+        """Write the host-side ansible.cfg and inventory, and make sure the box's ssh config trusts the instance"""
+        _, key_path = SSH.save_keypair(self.cfg.key_folder, self.cfg.key_type)
+        folder = self.folder()
+
+        client = ConnectionPool.client('root', self.ip, key_path)
+        SSHConfig(self.name).ensure(self.ip, ConnectionPool.port, self.cfg.user, key_path,
+                                    client.get_transport().get_remote_server_key())
+
+        # -- facts only last one run; a deleted and relaunched box would otherwise use the old instance's facts
+        shutil.rmtree(folder / 'facts', ignore_errors=True)
+
+        (folder / 'ansible.cfg').write_text(self.create_config())
+        (folder / 'inventory.yaml').write_text(inventory_config(self.name, key_path))
+
+        if Tracer.detailed:
+            (folder / 'callback_plugins').mkdir(exist_ok=True)
+            (folder / 'callback_plugins' / 'box_trace.py').write_text(ANSIBLE_CALLBACK)
+
+        return 0
+
+    def target(self, playbook: Path, name: str) -> Path:
+        return Path(playbook).resolve()
+
+    def site(self, scp: SCP, pending: list[tuple]) -> Path:
+        site_path = self.folder() / 'site.yaml'
+        site_path.write_text(self.create_site([playbook for playbook, _, _ in pending]))
+
+        return site_path
+
+    def execute(self, playbook: Path, log: Path) -> int:
+        """Run ansible-playbook on the host, from the playbook's folder"""
+        env = {**os.environ, 'ANSIBLE_CONFIG': str(self.folder() / 'ansible.cfg')}
+        cmd = ['ansible-playbook', str(playbook)]
+
+        if Tracer.detailed:
+            env['MYSTERY_BOX_TRACE'] = str(self.folder() / 'trace.jsonl')
+
+        if self.cfg.vars:
+            cmd += ['--extra-vars', json.dumps(self.cfg.vars)]
+
+        proc = subprocess.Popen(cmd, cwd=playbook.parent, env=env, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        ring = RingLog(log)
+
+        try:
+            return ProcessStreamer(proc, ring, self.name).run()
+        finally:
+            ring.close()
+
+    def collect_trace(self) -> None:
+        trace_path = self.folder() / 'trace.jsonl'
+
+        if trace_path.exists():
+            Tracer.record_ansible(trace_path.read_text(), f'{self.name} ansible')
+            trace_path.write_text('')
 
 
 class VMConfigurators():
     ansible = AnsibleConfiguration
+    ansible_push = AnsiblePushConfiguration
+
+    @staticmethod
+    def select(cfg: BoxConfig):
+        """The configurator chosen by the configurator key in box.yaml"""
+        return VMConfigurators.ansible_push if cfg.configurator == 'push' else VMConfigurators.ansible
@@ -0,0 +1,143 @@
+
+import os
+import subprocess
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+from .utils import cache_dir
+
+# -- paramiko is only needed for annotations; importing it would slow `box stop` and `box suspend`
+if TYPE_CHECKING:
+    import paramiko
+
+
+class SSHConfig:
+    """A generated OpenSSH client configuration for one box. It pins the box's host key in a
+    dedicated known_hosts file, and shares one ControlMaster connection between every `box in`
+    session, so only the first session pays for a handshake."""
+    name: str
+
+    # -- how long the master connection outlives its last session
+    persist: str = '10m'
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    @staticmethod
+    def folder() -> Path:
+        folder = cache_dir() / 'ssh'
+        folder.mkdir(mode=0o700, exist_ok=True)
+
+        return folder
+
+    @property
+    def config_path(self) -> Path:
+        return SSHConfig.folder() / f'{self.name}.config'
+
+    @property
+    def known_hosts_path(self) -> Path:
+        return SSHConfig.folder() / f'{self.name}.known_hosts'
+
+    def render(self, ip: str, port: int, user: str, key_path: Path) -> str:
+        lines = [
+            f'Host {self.name}',
+            f'  HostName {ip}',
+            f'  Port {port}',
+            f'  User {user}',
+            f'  IdentityFile {key_path}',
+            '  IdentitiesOnly yes',
+            f'  HostKeyAlias {self.name}',
+            f'  UserKnownHostsFile {self.known_hosts_path}',
+            '  StrictHostKeyChecking yes',
+            '  ServerAliveInterval 30'
+        ]
+
+        # -- Windows' OpenSSH cannot multiplex connections, so each session connects directly there
+        if os.name != 'nt':
+            lines += [
+                '  ControlMaster auto',
+                # -- box names cannot contain @, so a socket's box and user are unambiguous
+                f'  ControlPath {SSHConfig.folder()}/{self.name}@%r.sock',
+                f'  ControlPersist {self.persist}'
+            ]
+
+        return '\n'.join(lines) + '\n'
+
+    def current(self, ip: str) -> bool:
+        """Is there a configuration for this box at this address?"""
+        try:
+            content = self.config_path.read_text()
+        except FileNotFoundError:
+            return False
+
+        # -- configs naming sockets the older, ambiguous box-user way are rewritten
+        return f'  HostName {ip}\n' in content and (os.name == 'nt' or f'/{self.name}@%r.sock' in content)
+
+    def known_host(self, host_key: 'paramiko.PKey') -> str:
+        return f'{self.name} {host_key.get_name()} {host_key.get_base64()}\n'
+
+    def write(self, ip: str, port: int, user: str, key_path: Path, host_key: 'paramiko.PKey') -> None:
+        """Write the ssh config, and a known_hosts file trusting the box's host key"""
+        self.close()
+
+        with open(self.known_hosts_path, 'w') as conn:
+            conn.write(self.known_host(host_key))
+
+        with open(self.config_path, 'w') as conn:
+            conn.write(self.render(ip, port, user, key_path))
+
+    def ensure(self, ip: str, port: int, user: str, key_path: Path, host_key: 'paramiko.PKey') -> None:
+        """Write the ssh config, unless it already describes this address and host key"""
+        try:
+            trusted = self.known_hosts_path.read_text() == self.known_host(host_key)
+        except FileNotFoundError:
+            trusted = False
+
+        if not trusted or not self.current(ip):
+            self.write(ip, port, user, key_path, host_key)
+
+    def identity(self) -> Optional[Path]:
+        """The private key the box is logged into with, if it has a configuration"""
+        try:
+            content = self.config_path.read_text()
+        except FileNotFoundError:
+            return None
+
+        for line in content.splitlines():
+            if line.strip().startswith('IdentityFile '):
+                return Path(line.strip()[len('IdentityFile '):])
+
+        return None
+
+    def command(self, user: Optional[str] = None, cmd: Optional[str] = None) -> list[str]:
+        """The ssh command line for an interactive session, or for running cmd"""
+        argv = ['ssh', '-F', str(self.config_path)]
+
+        if user:
+            argv += ['-l', user]
+
+        argv.append(self.name)
+
+        if cmd:
+            argv += ['--', cmd]
+
+        return argv
+
+    def close(self) -> None:
+        """Stop the master connections, one per remote user, if any are running"""
+        if os.name == 'nt' or not os.path.exists(self.config_path):
+            return
+
+        for socket_path in SSHConfig.folder().glob(f'{self.name}@*.sock'):
+            user = socket_path.name[len(self.name) + 1:-len('.sock')]
+
+            subprocess.run(['ssh', '-F', str(self.config_path), '-l', user, '-O', 'exit', self.name],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def remove(self) -> None:
+        """Stop the master connection and forget the box, once it is deleted"""
+        self.close()
+
+        for fpath in [self.config_path, self.known_hosts_path]:
+            if os.path.exists(fpath):
+                os.remove(fpath)
@@ -0,0 +1,128 @@
+
+import sys
+import gzip
+import time
+import select
+import threading
+import subprocess
+import collections
+from pathlib import Path
+from typing import Optional
+import paramiko
+
+
+class RingLog:
+    """Holds recent output lines in a bounded ring buffer, draining them into a gzip-compressed
+    log file whenever it fills, so memory stays flat however long the output is"""
+    lines: collections.deque
+    pending: int
+
+    def __init__(self, fpath: Optional[Path], capacity: int = 1024) -> None:
+        self.lines = collections.deque(maxlen=capacity)
+        self.pending = 0
+        self.conn = gzip.open(fpath, 'wt', encoding='utf8') if fpath else None
+
+    def append(self, line: str) -> None:
+        self.lines.append(line)
+        self.pending += 1
+
+        if self.pending == self.lines.maxlen:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.conn and self.pending:
+            self.conn.write('\n'.join(list(self.lines)[-self.pending:]) + '\n')
+
+        self.pending = 0
+
+    def close(self) -> None:
+        self.flush()
+
+        if self.conn:
+            self.conn.close()
+
+
+class ChannelStreamer:
+    """Multiplexes a channel's stdout and stderr with select and non-blocking reads, emitting
+    timestamped lines as they arrive rather than draining one stream before the other"""
+    channel: paramiko.Channel
+    log: RingLog
+    name: Optional[str]
+
+    def __init__(self, channel: paramiko.Channel, log: RingLog, name: Optional[str] = None) -> None:
+        self.channel = channel
+        self.log = log
+        self.name = name
+        self.partial = {'stdout': b'', 'stderr': b''}
+
+    def emit(self, stream: str, line: bytes) -> None:
+        text = line.decode('utf8', errors='replace').rstrip('\r')
+
+        # -- lines from a fleet's boxes are interleaved, so each is labelled with its box
+        if self.name:
+            text = f'{self.name} | {text}'
+
+        stamped = f'[{time.strftime("%H:%M:%S")}] {text}'
+
+        print(stamped, file=sys.stderr if stream == 'stderr' else sys.stdout, flush=True)
+        self.log.append(stamped)
+
+    def receive(self, stream: str, data: bytes) -> None:
+        *lines, self.partial[stream] = (self.partial[stream] + data).split(b'\n')
+
+        for line in lines:
+            self.emit(stream, line)
+
+    def run(self) -> int:
+        """Stream until the remote command exits, and return its exit status"""
+        self.channel.setblocking(0)
+
+        while True:
+            select.select([self.channel], [], [], 1.0)
+
+            while self.channel.recv_ready():
+                self.receive('stdout', self.channel.recv(32768))
+
+            while self.channel.recv_stderr_ready():
+                self.receive('stderr', self.channel.recv_stderr(32768))
+
+            drained = not self.channel.recv_ready() and not self.channel.recv_stderr_ready()
+
+            if drained and (self.channel.exit_status_ready() or self.channel.eof_received):
+                break
+
+        for stream, rest in self.partial.items():
+            if rest:
+                self.emit(stream, rest)
+
+        return self.channel.recv_exit_status()
+
+
+class ProcessStreamer(ChannelStreamer):
+    """Streams a local process's stdout and stderr as timestamped lines, as ChannelStreamer does
+    for a remote command"""
+    proc: subprocess.Popen
+
+    def __init__(self, proc: subprocess.Popen, log: RingLog, name: Optional[str] = None) -> None:
+        self.proc = proc
+        self.log = log
+        self.name = name
+        self.lock = threading.Lock()
+
+    def pump(self, stream: str, pipe) -> None:
+        for line in iter(pipe.readline, b''):
+            with self.lock:
+                self.emit(stream, line.rstrip(b'\n'))
+
+    def run(self) -> int:
+        """Stream until the process exits, and return its exit status"""
+        pumps = [threading.Thread(target=self.pump, args=(stream, pipe), daemon=True)
+                 for stream, pipe in [('stdout', self.proc.stdout), ('stderr', self.proc.stderr)]]
+
+        for pump in pumps:
+            pump.start()
+
+        for pump in pumps:
+            pump.join()
+
+        return self.proc.wait()
@@ -0,0 +1,156 @@
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from typing import Optional
+from contextlib import contextmanager
+
+# -- an Ansible callback plugin, uploaded to the instance, that appends a JSON line per task
+# -- to the file named by MYSTERY_BOX_TRACE
+ANSIBLE_CALLBACK = '''
+import os
+import json
+import time
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'box_trace'
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self):
+        super().__init__()
+        self.path = os.environ.get('MYSTERY_BOX_TRACE')
+        self.task = None
+
+    def record(self, status):
+        if not self.path or not self.task:
+            return
+
+        name, start = self.task
+        self.task = None
+
+        with open(self.path, 'a') as conn:
+            conn.write(json.dumps({'name': name, 'start': start, 'end': time.time(), 'status': status}) + '\\n')
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.record('done')
+        self.task = (task.get_name(), time.time())
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.record('done')
+        self.task = (task.get_name(), time.time())
+
+    def v2_runner_on_ok(self, result):
+        self.record('ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.record('failed')
+
+    def v2_runner_on_skipped(self, result):
+        self.record('skipped')
+
+    def v2_runner_on_unreachable(self, result):
+        self.record('unreachable')
+
+    def v2_playbook_on_stats(self, stats):
+        self.record('done')
+'''
+
+
+class Tracer:
+    """Records nested, timed spans across a provisioning run, and exports them as Chrome trace-event
+    JSON (viewable in chrome://tracing or Perfetto). Spans are recorded on the current thread's
+    track, or on a named track for async stages that share the event-loop thread."""
+    events: list = []
+    tracks: dict = {}
+    lock = threading.Lock()
+
+    # -- set by --profile; additionally traces each Ansible task on the instance
+    detailed: bool = False
+
+    @classmethod
+    def track_id(cls, track: Optional[str]) -> int:
+        """Number each track, labelled by name; spans without a track go on their thread's track"""
+        if track is None:
+            track = threading.current_thread().name
+
+        with cls.lock:
+            if track not in cls.tracks:
+                cls.tracks[track] = len(cls.tracks) + 1
+
+            return cls.tracks[track]
+
+    @classmethod
+    def record(cls, name: str, start: float, end: float, args: dict, track: Optional[str] = None) -> None:
+        """Record a completed span; start and end are epoch seconds"""
+        event = {
+            'name': name,
+            'cat': 'box',
+            'ph': 'X',
+            'ts': round(start * 1e6),
+            'dur': round((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': cls.track_id(track),
+            'args': args
+        }
+
+        with cls.lock:
+            cls.events.append(event)
+
+    @classmethod
+    @contextmanager
+    def span(cls, name: str, track: Optional[str] = None, **args):
+        """Time the enclosed block. The yielded args dictionary can be extended with results, such as byte counts"""
+        start = time.time()
+
+        try:
+            yield args
+        finally:
+            cls.record(name, start, time.time(), args, track)
+
+    @classmethod
+    def record_ansible(cls, content: str, track: str) -> None:
+        """Record task spans written by the Ansible callback plugin"""
+        for line in content.splitlines():
+            try:
+                task = json.loads(line)
+            except ValueError:
+                continue
+
+            cls.record(task['name'], task['start'], task['end'], {'status': task['status']}, track)
+
+    @classmethod
+    def spans(cls) -> list[dict]:
+        with cls.lock:
+            return list(cls.events)
+
+    @classmethod
+    def export(cls, fpath: Path) -> None:
+        """Write every recorded span as Chrome trace-event JSON"""
+        with cls.lock:
+            names = [{
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': {'name': track}
+            } for track, tid in cls.tracks.items()]
+
+            content = {
+                'traceEvents': names + cls.events,
+                'displayTimeUnit': 'ms'
+            }
+
+        with open(fpath, 'w') as conn:
+            json.dump(content, conn)
+
+    @classmethod
+    def reset(cls) -> None:
+        with cls.lock:
+            cls.events = []
+            cls.tracks = {}
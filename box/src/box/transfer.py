@@ -0,0 +1,285 @@
+
+import os
+import json
+import time
+import shlex
+import hashlib
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import paramiko
+
+from .connections import ConnectionPool
+from .utils import logging
+from .tracing import Tracer
+
+# -- a large channel window keeps many write requests in flight before the instance acknowledges them
+WINDOW_SIZE = 64 * 1024 * 1024
+MAX_PACKET_SIZE = 32 * 1024
+BUFFER_SIZE = 1024 * 1024
+
+# -- files above this size have their individual throughput reported
+REPORT_SIZE = 1024 * 1024
+
+# -- files of at least this size are uploaded to a partial file that later attempts resume, and its
+# -- progress is recorded each time this many bytes are sent
+RESUME_SIZE = 64 * 1024 * 1024
+PROGRESS_SIZE = 64 * 1024 * 1024
+PARTIAL_SUFFIX = '.box-partial'
+
+
+def throughput(size: int, seconds: float) -> str:
+    """Format a transfer rate in MiB/s"""
+    rate = size / max(seconds, 1e-6) / (1024 * 1024)
+    return f'{rate:.1f} MiB/s'
+
+
+class TransferEngine:
+    """Upload many files concurrently, using a bounded pool of workers that each own
+    an SFTP channel on one shared transport. Writes are pipelined, so workers do not wait
+    for an acknowledgement per request. Large files are uploaded resumably, and checksummed."""
+    user: str
+    ip: str
+    key_path: Path
+    workers: int
+
+    # -- how many times an interrupted resumable upload is resumed before giving up
+    retries: int = 2
+
+    def __init__(self, user: str, ip: str, key_path: Path, workers: int = 4) -> None:
+        self.user = user
+        self.ip = ip
+        self.key_path = key_path
+        self.workers = workers
+        self.local = threading.local()
+        self.channels = []
+        self.rekey_limits = {}
+        self.lock = threading.Lock()
+
+    def sftp(self) -> paramiko.SFTPClient:
+        """Retrieve this worker's SFTP channel, opening it on the pooled transport if required"""
+        sftp = getattr(self.local, 'sftp', None)
+
+        if sftp is None or sftp.get_channel().closed:
+            client = ConnectionPool.client(self.user, self.ip, self.key_path)
+            transport = client.get_transport()
+
+            sftp = paramiko.SFTPClient.from_transport(
+                transport, window_size=WINDOW_SIZE, max_packet_size=MAX_PACKET_SIZE)
+
+            self.local.sftp = sftp
+            with self.lock:
+                self.channels.append(sftp)
+
+                # -- avoid re-keying midway through large transfers. The transport is pooled and outlives
+                # -- this upload, so its limits are restored once the upload finishes
+                if transport not in self.rekey_limits:
+                    packetizer = transport.packetizer
+                    self.rekey_limits[transport] = (packetizer.REKEY_BYTES, packetizer.REKEY_PACKETS)
+                    packetizer.REKEY_BYTES = pow(2, 40)
+                    packetizer.REKEY_PACKETS = pow(2, 40)
+
+        return sftp
+
+    def run(self, cmd: str) -> str:
+        """Run a command on the instance, returning its output"""
+        client = ConnectionPool.client(self.user, self.ip, self.key_path)
+        channel = client.get_transport().open_session()
+
+        try:
+            channel.exec_command(cmd)
+            output = b''.join(iter(lambda: channel.recv(65536), b''))
+
+            if channel.recv_exit_status() != 0:
+                raise IOError(f'"{cmd}" failed on {self.ip}')
+
+            return output.decode('utf8')
+        finally:
+            channel.close()
+
+    def remote_sha256(self, path: str, length: Optional[int] = None) -> str:
+        """Hash a remote file, or only its first length bytes"""
+        target = shlex.quote(path)
+        cmd = f'head -c {length} {target} | sha256sum' if length is not None else f'sha256sum {target}'
+
+        return self.run(cmd).split()[0]
+
+    def resume(self, sftp: paramiko.SFTPClient, local, partial: str, source: dict):
+        """Find where an earlier upload of this source to partial can resume from, and the hash of the local
+        bytes before that offset. The offset is 0 if there was no earlier upload, or the instance's copy of
+        those bytes does not match"""
+        digest = hashlib.sha256()
+
+        try:
+            with sftp.open(f'{partial}.json', 'r') as conn:
+                progress = json.loads(conn.read())
+
+            partial_size = sftp.stat(partial).st_size
+        except (IOError, ValueError):
+            return 0, digest
+
+        offset = progress.get('offset', 0)
+
+        if {key: progress.get(key) for key in source} != source or not 0 < offset <= partial_size:
+            return 0, digest
+
+        for chunk in iter(lambda: local.read(min(BUFFER_SIZE, offset - local.tell())), b''):
+            digest.update(chunk)
+
+        if self.remote_sha256(partial, offset) != digest.hexdigest():
+            logging.info(f'📦 the partial upload {partial} does not match its source; starting again')
+            local.seek(0)
+
+            return 0, hashlib.sha256()
+
+        return offset, digest
+
+    def record(self, sftp: paramiko.SFTPClient, partial: str, progress: dict) -> None:
+        """Record the source and offset of a partial upload beside it"""
+        with sftp.open(f'{partial}.json', 'w') as conn:
+            conn.write(json.dumps(progress))
+
+    def put_resumable(self, src: Path, dest: Path) -> dict:
+        """Upload a large file to a partial file beside dest, recording progress as it goes. An upload interrupted
+        earlier resumes from its last recorded offset, once the instance's copy of the bytes before it is verified.
+        The complete file is checksummed on the instance before it is renamed into place"""
+        sftp = self.sftp()
+        partial = f'{dest}{PARTIAL_SUFFIX}'
+        stat = os.stat(src)
+        source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        start_time = time.monotonic()
+
+        with Tracer.span('copy', src=str(src), dest=str(dest)) as span, open(src, 'rb') as local:
+            offset, digest = self.resume(sftp, local, partial, source)
+            resumed = offset
+
+            if resumed:
+                logging.info(f'📦 resuming the upload of {src} at byte {resumed}')
+
+            self.record(sftp, partial, {**source, 'offset': offset})
+
+            while offset < source['size']:
+                # -- closing each segment waits for the instance to write it, before its progress is recorded
+                with sftp.open(partial, 'r+b' if offset else 'wb', BUFFER_SIZE) as remote:
+                    remote.seek(offset)
+                    remote.set_pipelined(True)
+                    end = min(offset + PROGRESS_SIZE, source['size'])
+
+                    while offset < end:
+                        chunk = local.read(min(BUFFER_SIZE, end - offset))
+
+                        if not chunk:
+                            raise IOError(f'{src} changed during upload')
+
+                        remote.write(chunk)
+                        digest.update(chunk)
+                        offset += len(chunk)
+
+                self.record(sftp, partial, {**source, 'offset': offset})
+
+            if self.remote_sha256(partial) != digest.hexdigest():
+                sftp.remove(partial)
+                sftp.remove(f'{partial}.json')
+                raise IOError(f'{dest} did not match {src} after upload')
+
+            sftp.posix_rename(partial, str(dest))
+            sftp.remove(f'{partial}.json')
+
+            size = offset - resumed
+            seconds = time.monotonic() - start_time
+            span.update(bytes=size, resumed=resumed, throughput=throughput(size, seconds))
+
+        logging.info(f'📦 copied {src} ({size} bytes, {throughput(size, seconds)}, verified)')
+
+        return {
+            'src': src,
+            'dest': dest,
+            'size': size,
+            'seconds': seconds
+        }
+
+    def put(self, src: Path, dest: Path) -> dict:
+        """Upload a single file, returning its size and elapsed time"""
+        if os.path.getsize(src) >= RESUME_SIZE:
+            for attempt in range(self.retries + 1):
+                try:
+                    return self.put_resumable(src, dest)
+                except (OSError, EOFError, paramiko.SSHException) as err:
+                    if attempt == self.retries:
+                        logging.error(f'📦 the upload of {src} failed; the next run resumes it from its last recorded offset')
+                        raise
+
+                    # -- reopen the channel, reconnecting if the transport was lost
+                    logging.warning(f'📦 the upload of {src} was interrupted ({err}); resuming it')
+                    self.local.sftp = None
+
+        sftp = self.sftp()
+        start_time = time.monotonic()
+        size = 0
+
+        with Tracer.span('copy', src=str(src), dest=str(dest)) as span:
+            with open(src, 'rb') as local, sftp.open(str(dest), 'wb', BUFFER_SIZE) as remote:
+                remote.set_pipelined(True)
+
+                for chunk in iter(lambda: local.read(BUFFER_SIZE), b''):
+                    remote.write(chunk)
+                    size += len(chunk)
+
+            seconds = time.monotonic() - start_time
+            span.update(bytes=size, throughput=throughput(size, seconds))
+
+        if size >= REPORT_SIZE:
+            logging.info(f'📦 copied {src} ({size} bytes, {throughput(size, seconds)})')
+
+        return {
+            'src': src,
+            'dest': dest,
+            'size': size,
+            'seconds': seconds
+        }
+
+    def upload(self, jobs: list[tuple[Path, Path]], on_done: Optional[Callable] = None) -> list[dict]:
+        """Upload (src, dest) pairs concurrently. on_done is called with each completed (src, dest) pair;
+        every job is attempted, and the first failure is raised once all have finished"""
+        start_time = time.monotonic()
+        results = []
+        failure = None
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(self.put, src, dest): (src, dest) for src, dest in jobs}
+
+                for future in as_completed(futures):
+                    src, dest = futures[future]
+
+                    try:
+                        results.append(future.result())
+                    except Exception as err:
+                        failure = failure or IOError(f'failed copying {src} to {dest}: {err}')
+                        continue
+
+                    if on_done:
+                        on_done(src, dest)
+        finally:
+            for sftp in self.channels:
+                sftp.close()
+
+            for transport, (rekey_bytes, rekey_packets) in self.rekey_limits.items():
+                transport.packetizer.REKEY_BYTES = rekey_bytes
+                transport.packetizer.REKEY_PACKETS = rekey_packets
+
+            self.channels = []
+            self.rekey_limits = {}
+
+        if results:
+            size = sum(result['size'] for result in results)
+            seconds = time.monotonic() - start_time
+
+            logging.info(
+                f'📦 copied {len(results)} files, {size} bytes in {seconds:.1f}s ({throughput(size, seconds)}, {self.workers} workers)')
+
+        if failure:
+            raise failure
+
+        return results
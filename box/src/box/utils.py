@@ -1,5 +1,17 @@
 
+import os
 import logging
+from pathlib import Path
 
 
 logging.basicConfig(level=logging.INFO)
+
+
+def cache_dir() -> Path:
+    """The host folder in which box persists state between runs"""
+    base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+
+    folder = Path(base) / 'mystery-box'
+    folder.mkdir(parents=True, exist_ok=True)
+
+    return folder